@@ -0,0 +1,278 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import PIL
+import PIL.Image
+
+import generate_card
+
+# Constants
+MODES = ('full', 'mini', 'batch')
+MODE_VARIANTS = {
+        'full' : ('full',),
+        'mini' : ('mini',),
+        'batch' : generate_card.VARIANTS, # Every variant from one composite, through `generate_card.batch`
+        }
+
+STRESS_ART_SIZE = (6000, 8000)
+STRESS_PARENT_DEPTH = 8
+STRESS_EFFECT = 'Gain 2 {strength} and 1 {endurance} next Scene; if the Target has 5+ {burn}, Inflict 3 {bleed} and 2 {paralysis}'
+
+DEFAULT_THRESHOLD = 0.15 # Fraction of cards/second that may be lost before failing
+DEFAULT_RSS_THRESHOLD = 0.25 # Fraction of peak memory that may be gained before failing
+SETUP_SLACK = 0.05 # Seconds setting up may slow down by on top of the threshold, as it is short enough to be noisy
+
+def write_json(path, data):
+    with open(path, 'w') as path_fd:
+        json.dump(data, path_fd, indent=4)
+
+def make_stress_cards(stress_dir, keyword_data):
+    '''
+    Writes synthetic cards which push each part of rendering to its limits:
+    four dice with long effects, text full of keyword icons, huge art, and a deep parent chain.
+
+    @param keyword_data a dictionary object obtained from an `init_data` call
+    @return a list of the card paths
+    '''
+    # Noise makes for a worst case to decode and resize
+    art = PIL.Image.effect_noise(STRESS_ART_SIZE, 64).convert('RGB')
+    art.save(os.path.join(stress_dir, 'stress_art.jpg'), quality=90)
+    PIL.Image.effect_noise((600, 800), 64).convert('RGB').save(os.path.join(stress_dir, 'small_art.jpg'))
+
+    icons = [ kw for kw, kw_data in keyword_data.items()
+            if isinstance(kw_data, dict) and 'image' in kw_data ]
+    icon_text = ' '.join( '{%s}' % kw for kw in icons )
+
+    base = {
+        'name' : 'Stress Test',
+        'cost' : 4,
+        'type' : 'melee',
+        'rarity' : 'limited',
+        'grit' : True,
+        'art' : './small_art.jpg',
+        'preamble' : '{combatstart} ' + STRESS_EFFECT,
+        'dice' : [ { 'type' : dice_type, 'range' : '{d20}', 'effect' : '{hit} ' + STRESS_EFFECT }
+            for dice_type in ('slash', 'pierce', 'blunt', 'block_counter') ],
+    }
+    cards = {
+        'stress_dice.json' : base,
+        'stress_icons.json' : dict(base, preamble=icon_text, dice=[ dict(dice, effect=icon_text) for dice in base['dice'][:2] ]),
+        'stress_art.json' : dict(base, art='./stress_art.jpg'),
+    }
+
+    # Each level of the chain overrides one more field
+    chain = [ 'stress_chain_%d.json' % depth for depth in range(STRESS_PARENT_DEPTH) ]
+    cards[chain[0]] = base
+    overrides = [ ('cost', 1), ('rarity', 'hardcover'), ('name', 'Deep Stress'), ('type', 'ranged'), ('grit', False) ]
+    for depth in range(1, STRESS_PARENT_DEPTH):
+        field, value = overrides[depth % len(overrides)]
+        cards[chain[depth]] = { 'parent' : './' + chain[depth - 1], field : value }
+
+    for name, card in cards.items():
+        write_json(os.path.join(stress_dir, name), card)
+    return [ os.path.join(stress_dir, name) for name in sorted(cards) if not name.startswith('stress_chain_') ] \
+            + [ os.path.join(stress_dir, chain[-1]) ]
+
+def run_mode(mode, cards, asset_path, keyword_path, repeat, options):
+    '''
+    Renders every card `repeat` times in one mode. Meant to run in a fresh process, so that peak memory is its own.
+    Setting up (verifying + opening the psd, loading the keywords) counts towards the time taken:
+    once for `full` and `mini`, which share a renderer, and once per repeat for `batch`, which runs a whole batch
+    (validation, manifest and all) each time. The output store is off, so repeats render rather than link.
+
+    @return a dictionary of the results
+    '''
+    options = dict(options, store_outputs=False)
+    profile = generate_card.ProfileReport()
+    setup_seconds = None
+    with tempfile.TemporaryDirectory() as output_dir:
+        rendered = 0
+        start = time.perf_counter()
+        if mode == 'batch':
+            card_list = os.path.join(output_dir, 'cards.txt')
+            with open(card_list, 'w') as card_list_fd:
+                card_list_fd.write('\n'.join(cards) + '\n')
+            for i in range(repeat):
+                with redirect_stdout(io.StringIO()):
+                    failures = generate_card.batch(card_list, os.path.join(output_dir, str(i)), asset_path, keyword_path,
+                            MODE_VARIANTS[mode],
+                            profile=profile,
+                            **options)
+                assert not failures, '%d card(s) failed to render' % failures
+                rendered += len(cards)
+        else:
+            with generate_card.track_stages() as setup_stages:
+                renderer = generate_card.CardRenderer(asset_path, keyword_path, **options)
+            setup_seconds = time.perf_counter() - start
+            profile.add(setup_stages)
+            for i in range(repeat):
+                for card_path in cards:
+                    target = os.path.join(output_dir, os.path.splitext(os.path.basename(card_path))[0] + '.png')
+                    outputs = [ (variant, generate_card.variant_path(target, variant)) for variant in MODE_VARIANTS[mode] ]
+                    with generate_card.track_stages() as stages:
+                        with generate_card.profile_stage('load'):
+                            data = generate_card.init_data('', card_path)
+                        renderer.render(data, outputs)
+                    profile.add(stages, card_path)
+                    rendered += 1
+        elapsed = time.perf_counter() - start
+
+    peak = generate_card.peak_rss_kb()
+    return {
+        'cards' : rendered,
+        'seconds' : elapsed,
+        'cards_per_second' : rendered / elapsed,
+        'setup_seconds' : setup_seconds,
+        'peak_rss_mb' : peak / 1024 if peak is not None else None,
+        'stages_ms' : { name : 1000 * total['wall'] / total['count'] for name, total in profile.totals.items() },
+    }
+
+def compare(results, baseline, threshold, rss_threshold):
+    '''
+    @return a list of regressions (as messages) of `results` against `baseline`
+    '''
+    regressions = []
+    for mode, result in results.items():
+        base = baseline.get(mode, None)
+        if base is None:
+            continue
+        slowest = base['cards_per_second'] * (1 - threshold)
+        if result['cards_per_second'] < slowest:
+            regressions.append('%s: %.2f cards/s is below %.2f (baseline %.2f - %d%%)' % (mode,
+                result['cards_per_second'],
+                slowest,
+                base['cards_per_second'],
+                100 * threshold))
+        if result['setup_seconds'] is not None and base.get('setup_seconds', None) is not None:
+            slowest = base['setup_seconds'] * (1 + threshold) + SETUP_SLACK
+            if result['setup_seconds'] > slowest:
+                regressions.append('%s: setting up took %.3fs, above %.3fs (baseline %.3fs + %d%% + %.2fs)' % (mode,
+                    result['setup_seconds'],
+                    slowest,
+                    base['setup_seconds'],
+                    100 * threshold,
+                    SETUP_SLACK))
+        if result['peak_rss_mb'] is not None and base.get('peak_rss_mb', None) is not None:
+            largest = base['peak_rss_mb'] * (1 + rss_threshold)
+            if result['peak_rss_mb'] > largest:
+                regressions.append('%s: peak rss %.1fMB is above %.1fMB (baseline %.1fMB + %d%%)' % (mode,
+                    result['peak_rss_mb'],
+                    largest,
+                    base['peak_rss_mb'],
+                    100 * rss_threshold))
+    return regressions
+
+def print_results(results, baseline):
+    print('%-6s %8s %10s %12s %10s %12s' % ('mode', 'cards', 'cards/s', 'baseline', 'setup s', 'peak rss MB'))
+    for mode, result in results.items():
+        base = baseline.get(mode, {}).get('cards_per_second', None)
+        print('%-6s %8d %10.2f %12s %10s %12s' % (mode,
+            result['cards'],
+            result['cards_per_second'],
+            '%.2f' % base if base is not None else '-',
+            '%.3f' % result['setup_seconds'] if result.get('setup_seconds', None) is not None else '-',
+            '%.1f' % result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-'))
+
+    stages = list(dict.fromkeys( name for result in results.values() for name in result['stages_ms'] ))
+    print()
+    print('%-12s' % 'mean ms' + ''.join( '%10s' % mode for mode in results ))
+    for name in stages:
+        print('%-12s' % name + ''.join( '%10s' % ('%.2f' % result['stages_ms'][name] if name in result['stages_ms'] else '-')
+            for result in results.values() ))
+
+def main(data_path, asset_path, keyword_path, baseline_path, modes=MODES, repeat=3, stress=True,
+        save_baseline=False, threshold=DEFAULT_THRESHOLD, rss_threshold=DEFAULT_RSS_THRESHOLD, **options):
+    '''
+    @return the number of regressions against the baseline
+    '''
+    root, cards = generate_card.find_cards(data_path)
+    with tempfile.TemporaryDirectory() as stress_dir:
+        if stress:
+            cards += make_stress_cards(stress_dir, generate_card.init_data('', keyword_path))
+
+        results = {}
+        for mode in modes:
+            # A fresh process per mode, so peak memory isn't carried over from the last
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[mode] = executor.submit(run_mode, mode, cards, asset_path, keyword_path, repeat, options).result()
+
+    baseline = {}
+    if os.path.isfile(baseline_path):
+        with open(baseline_path, 'r') as baseline_fd:
+            baseline = json.load(baseline_fd)
+
+    print_results(results, baseline)
+    regressions = compare(results, baseline, threshold, rss_threshold)
+    print()
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if not regressions:
+        print('No regressions' if baseline else 'No baseline at %s to compare against' % baseline_path)
+
+    if save_baseline:
+        write_json(baseline_path, dict(baseline, **results))
+        print('Saved baseline to %s' % baseline_path)
+    return len(regressions)
+
+def parse_modes(text):
+    modes = [ mode.strip() for mode in text.split(',') if mode.strip() ]
+    for mode in modes:
+        if mode not in MODES:
+            raise argparse.ArgumentTypeError('No such mode: %s (choose from %s)' % (mode, ', '.join(MODES)))
+    return tuple(dict.fromkeys(modes))
+
+def get_args():
+    # Parse command line using the built-in argparse library
+    parser = argparse.ArgumentParser(description='Benchmarks rendering the test cards (and synthetic stress cards), '
+            'failing if cards/second or peak memory regress against a saved baseline')
+    parser.add_argument('-d', '--data-path', type=str, default=None,
+            help='Cards to benchmark, as for `generate_card.py -b`. Defaults to ../data/test (relative to this script)')
+    parser.add_argument('-a', '--asset-path', type=str, default=None,
+            help='Path to the assets folder. Defaults to ../assets (relative to this script)')
+    parser.add_argument('-k', '--keyword-path', type=str, default=None,
+            help='Path to keywords JSON. Defaults to ../assets/keywords.json (also relative)')
+    parser.add_argument('-c', '--cache-dir', type=str, default=None,
+            help='Cache folder to render with, as for `generate_card.py`. Off by default')
+    parser.add_argument('-B', '--baseline', type=str, default='benchmark_baseline.json',
+            help='Baseline to compare against (and save to). Defaults to ./benchmark_baseline.json')
+    parser.add_argument('-s', '--save-baseline', action='store_true', default=False,
+            help='Save these results as the new baseline')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='Number of times to render every card in each mode')
+    parser.add_argument('--modes', type=parse_modes, default=MODES,
+            help='Comma separated modes to benchmark, out of %s' % ', '.join(MODES))
+    parser.add_argument('--no-stress', action='store_true', default=False,
+            help='Only benchmark the cards in the data path, without the synthetic stress cards')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+            help='Fail if cards/second drops by more than this fraction of the baseline')
+    parser.add_argument('--rss-threshold', type=float, default=DEFAULT_RSS_THRESHOLD,
+            help='Fail if peak memory grows by more than this fraction of the baseline')
+    args = parser.parse_args()
+
+    # As stated in the help text, relative to `<scriptdir>/../`
+    if args.data_path is None:
+        args.data_path = os.path.join(os.path.dirname(sys.argv[0]), '..', 'data', 'test')
+    if args.asset_path is None:
+        args.asset_path = os.path.join(os.path.dirname(sys.argv[0]), '..', 'assets')
+    if args.keyword_path is None:
+        args.keyword_path = os.path.join(os.path.dirname(sys.argv[0]), '..', 'assets', 'keywords.json')
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    regressions = main(args.data_path, args.asset_path, args.keyword_path, args.baseline,
+            modes=args.modes,
+            repeat=args.repeat,
+            stress=not args.no_stress,
+            save_baseline=args.save_baseline,
+            threshold=args.threshold,
+            rss_threshold=args.rss_threshold,
+            cache_dir=args.cache_dir)
+    sys.exit(1 if regressions else 0)
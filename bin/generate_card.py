@@ -1,20 +1,40 @@
 import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
+from functools import lru_cache
 import hashlib
 import json
-from math import ceil
+from math import ceil, cos, floor, radians, sin
+import multiprocessing
 import os
+import pickle
+import shutil
 import sys
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import PIL
 import PIL.ImageFont
 import PIL.Image
 import PIL.ImageDraw
 import PIL.ImageOps
+import PIL.ImageChops
+import PIL.ImageColor
 
+import psd_tools
 from psd_tools import PSDImage
 from psd_tools.api.layers import PixelLayer
 from psd_tools.compression import Compression
+from psd_tools.constants import BlendMode
 
 # Constants
 COLOR_TITLE = "#000000"
@@ -50,53 +70,486 @@ MINI_LEFT = 20
 MINI_RIGHT = 520
 MINI_DOWN = 700
 
+# What the template has layers for, so that cards can be checked without opening it (see `validate_card`)
+PAGE_TYPES = ('melee', 'ranged', 'instant', 'mass')
+DICE_TYPES = ('slash', 'pierce', 'blunt', 'block', 'evade',
+        'slash_counter', 'pierce_counter', 'blunt_counter', 'block_counter', 'evade_counter')
+DICE_COUNTS = (1, 2, 3, 4) # Layouts under `Number of Dice`
+# Rarity -> (cost grit, cost outline color)
+RARITIES = {
+    'paperback' : ('cost_grit_paperback.png', '#9FE195'),
+    'hardcover' : ('cost_grit_hardcover.png', '#9FC3EF'),
+    'limited' : ('cost_grit_limited.png', '#B78BE5'),
+    "objet d'art" : ('cost_grit_objet.png', '#FFCB69'),
+    'e.g.o' : ('cost_grit_ego.png', '#FFFFDB'),
+}
+
+# The outputs that can be made from one card, see `CardRenderer.render`
+VARIANTS = ('full', 'mini')
+
+# Composited templates without art (see `TemplateCache`); small, as there are only so many page layouts
+TEMPLATE_CACHE_BYTES = 256 * 1024 * 1024
+TEMPLATE_CACHE_MEMORY = 32
+# Rendered outputs by the hash of what they were rendered from, see `OutputStore`
+OUTPUT_STORE_BYTES = 1024 * 1024 * 1024
+# Files at least this large have their md5 kept across runs, see `HashCache`
+HASH_PERSIST_BYTES = 1024 * 1024
+# Once a cache folder outgrows its limit, it is trimmed down to this fraction of it, see `LruFolder`
+LRU_EVICT_TO = 0.9
+# Decoded icons, see `AssetCache`
+ASSET_CACHE_ENTRIES = 256
+ASSET_CACHE_BYTES = 64 * 1024 * 1024
+ART_CACHE_ENTRIES = 4 # Scaled art kept in memory, mostly for previews of the same card (see `CardLayers`)
+ART_CACHE_BYTES = 256 * 1024 * 1024 # Scaled art kept on disk
+ART_DRAFT_GAP = 2 # Jpeg art is decoded at a fraction of its size, but still at least this many times the target size
+ART_JPEG_REDUCTION = 8 # The most a jpeg can be shrunk on each side while decoding
+# Art decoding to more pixels than this fails before it is decoded (about 4 bytes a pixel)
+ART_MAX_PIXELS = 64 * 1024 * 1024
+ART_REDUCING_GAP = 3.0 # See `PIL.Image.resize`, which first reduces art this many times larger than the target
+# Measured words, see `keyword_width`
+TEXT_WIDTH_ENTRIES = 100000
+TOKEN_ENTRIES = 10000 # Tokenised texts kept by each `KeywordIndex`
+TITLE_ENTRIES = 1024 # Rotated titles kept by `add_title`
+WORD_MASK_ENTRIES = 20000 # Rasterised words kept by `draw_word`, 0 to rasterise every time
+
+# How outputs are encoded, see `save_image`. None leaves it up to PIL
+ENCODING = {
+    'format' : 'png', # Or 'webp'
+    'png_compress_level' : None, # 0 (fastest, largest) to 9 (slowest, smallest)
+    'png_strategy' : None, # One of `PNG_STRATEGIES`
+    'quantize_mini' : 0, # Number of palette colors to reduce a mini png to, 0 to keep full color
+    'webp_lossless' : False,
+    'webp_quality' : 90,
+    'webp_method' : 4, # 0 (fastest) to 6 (smallest)
+}
+PNG_STRATEGIES = {
+    'default' : zlib.Z_DEFAULT_STRATEGY,
+    'filtered' : zlib.Z_FILTERED,
+    'huffman' : zlib.Z_HUFFMAN_ONLY,
+    'rle' : zlib.Z_RLE,
+    'fixed' : zlib.Z_FIXED,
+}
+
+# How a card's art is put under the template, see `CardRenderer.composite`
+ART_MODES = ('pil', 'psd', 'verify')
+ART_TOLERANCE = 2 # Largest difference (out of 255) allowed between the two, when verifying
+
+# Cards per sheet of a deck, see `deck`. Tabletop Simulator takes at most 10 x 7
+DECK_COLUMNS = 10
+DECK_ROWS = 7
+
+# Kept in the output folder of a batch, see `Manifest`
+MANIFEST_NAME = '.manifest.json'
+
 PSD_NAME = 'lor_template.psd'
 PSD_MD5 = '53ed4a18dbd596add12463898e6a95bd'
 
-def find_font(name,size):
+# Every input file read while rendering the current card, see `track_inputs`
+tracked_inputs = threading.local()
+
+def record_input(path):
+    inputs = getattr(tracked_inputs, 'paths', None)
+    if inputs is not None:
+        inputs.add(os.path.abspath(path))
+
+@contextmanager
+def track_inputs():
+    '''
+    Records the path of every input file read (via `record_input`) within this context
+    '''
+    tracked_inputs.paths = set()
+    try:
+        yield tracked_inputs.paths
+    finally:
+        tracked_inputs.paths = None
+
+# The stages profiled while rendering the current card, see `track_stages`
+tracked_stages = threading.local()
+
+def limit_memory(megabytes):
+    '''
+    Caps the memory (address space, which runs a little above what is actually used) of this process.
+    Past it, allocations fail with a MemoryError, so a card with art too large to fit fails on its own.
+    '''
+    if resource is None:
+        print('Memory limits are not supported on this platform', file=sys.stderr)
+        return
+    limit = megabytes * 1024 * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def peak_rss_kb():
+    if resource is None:
+        return None # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak # Bytes on macOS, kilobytes elsewhere
+
+@contextmanager
+def profile_stage(name):
+    '''
+    Adds the wall time, cpu time and peak memory growth of this context to stage `name`, if stages are being tracked.
+    The growth is how far this context pushed the peak memory of the process, so that it is put down to the stage
+    which allocated it, rather than to every stage after it (a stage nested in another counts towards both)
+    '''
+    stages = getattr(tracked_stages, 'stages', None)
+    if stages is None:
+        yield
+        return
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    peak = peak_rss_kb()
+    try:
+        yield
+    finally:
+        stage = stages.setdefault(name, { 'wall' : 0.0, 'cpu' : 0.0, 'peak_growth_kb' : None })
+        stage['wall'] += time.perf_counter() - wall
+        stage['cpu'] += time.process_time() - cpu
+        if peak is not None:
+            stage['peak_growth_kb'] = (stage['peak_growth_kb'] or 0) + peak_rss_kb() - peak
+
+@contextmanager
+def track_stages(enabled=True):
+    '''
+    Records every `profile_stage` within this context, into the yielded dictionary (None if not `enabled`)
+    '''
+    tracked_stages.stages = {} if enabled else None
+    try:
+        yield tracked_stages.stages
+    finally:
+        tracked_stages.stages = None
+
+class ProfileReport:
+    '''
+    Collects the stages profiled (see `track_stages`) for every card of a run.
+    Each card is written as a line of JSON to `path` (if given), and `summary` aggregates them into a table.
+    '''
+    def __init__(self, path=None):
+        self.totals = {}
+        self.cards = 0
+        self.fd = open(path, 'w') if path is not None else None
+
+    def add(self, stages, card_path=None):
+        '''
+        @param card_path the card these stages are from, None for setting up a renderer (verifying + opening the psd...)
+        '''
+        if card_path is not None:
+            self.cards += 1
+        if self.fd is not None:
+            line = { 'card' : card_path, 'stages' : stages } if card_path is not None else { 'setup' : stages }
+            self.fd.write(json.dumps(line) + '\n')
+
+        for name, stage in stages.items():
+            total = self.totals.setdefault(name, { 'count' : 0, 'wall' : 0.0, 'cpu' : 0.0, 'peak_growth_kb' : None })
+            total['count'] += 1
+            total['wall'] += stage['wall']
+            total['cpu'] += stage['cpu']
+            if stage['peak_growth_kb'] is not None:
+                total['peak_growth_kb'] = (total['peak_growth_kb'] or 0) + stage['peak_growth_kb']
+
+    def summary(self, out=sys.stderr):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+        print('Profiled %d card(s)' % self.cards, file=out)
+        print('%-12s %6s %10s %10s %10s %12s' % ('stage', 'count', 'total s', 'mean ms', 'cpu ms', 'peak +MB'), file=out)
+        for name, total in self.totals.items():
+            growth = total['peak_growth_kb']
+            print('%-12s %6d %10.3f %10.2f %10.2f %12s' % (name,
+                total['count'],
+                total['wall'],
+                1000 * total['wall'] / total['count'],
+                1000 * total['cpu'] / total['count'],
+                '%.1f' % (growth / 1024) if growth is not None else '-'), file=out)
+        # Only this process; those of a batch's workers are their own
+        peak = peak_rss_kb()
+        if peak is not None:
+            print('Peak memory of this process: %.1fMB' % (peak / 1024), file=out)
+
+@contextmanager
+def atomic_write(path):
+    '''
+    Yields a temporary path (unique to this process and thread) to write `path` to, which then replaces it,
+    so that a reader never sees half a file. Nothing is replaced if writing fails
+    '''
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class LruFolder:
+    '''
+    Keeps a cache folder within `max_bytes`, removing its least recently modified files first
+    (caches touch, with `os.utime`, the entries they reuse, so those are removed last).
+    Rather than scanning the whole folder for every file added, the size of the files added by this process is
+    added up, and the folder is only scanned once that takes it past `max_bytes`. It is then trimmed down to
+    `LRU_EVICT_TO` of that, so scans stay far apart. Files added by other processes are counted at the next scan.
+    '''
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = None # Not known until the first scan
+        self.lock = threading.Lock() # Outputs may be added from several encode threads
+
+    def added(self, entry):
+        with self.lock:
+            if self.size is None:
+                self.evict(self.max_bytes)
+                return
+            try:
+                self.size += os.path.getsize(entry)
+            except FileNotFoundError:
+                pass # Already evicted by another process
+            if self.size > self.max_bytes:
+                self.evict(int(self.max_bytes * LRU_EVICT_TO))
+
+    def evict(self, max_bytes):
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                continue # Other processes may be evicting too
+            entries.append( (stat.st_mtime, stat.st_size, entry) )
+
+        total = sum( size for _, size, _ in entries )
+        for _, size, entry in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+
+def versioned_folder(root, version):
+    '''
+    @return the folder `<root>/<version>/`, after removing anything else in `root`,
+    as entries made by any other version (of the template, or of this script) are dead weight
+    '''
+    path = os.path.join(root, version)
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(root):
+        if name != version:
+            stale = os.path.join(root, name)
+            if os.path.isdir(stale):
+                shutil.rmtree(stale, ignore_errors=True)
+            else:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass # Other processes may be removing it too
+    return path
+
+def open_image(path):
+    record_input(path)
+    return PIL.Image.open(path)
+
+class AssetCache:
+    '''
+    Decoded icons (keywords, dice, cost grit), keyed by (path, max height, colour) as they are drawn:
+    colourised (see `colorize_icon`) if a colour is given, then shrunk to fit within the max height.
+    Keeps the most recently used `max_entries` in memory, and if given a `cache_dir`,
+    persists the processed ones under `<cache_dir>/assets/` across runs,
+    evicting the least recently used once they take up more than `max_bytes`.
+    '''
+    def __init__(self, max_entries=ASSET_CACHE_ENTRIES, max_bytes=ASSET_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = None
+        self.memory = OrderedDict()
+
+    def persist(self, cache_dir):
+        # Icons are processed by this script, so a change to it may change them too
+        self.path = versioned_folder(os.path.join(cache_dir, 'assets'), code_md5())
+        self.lru = LruFolder(self.path, self.max_bytes)
+
+    def remember(self, key, img):
+        self.memory[key] = img
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, path, max_height=None, color=None):
+        record_input(path)
+        stat = os.stat(path)
+        # The size + modified time keep a long running process from drawing stale icons
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, max_height, color)
+        img = self.memory.get(key, None)
+        if img is not None:
+            self.memory.move_to_end(key)
+            return img
+
+        processed = max_height is not None or color is not None
+        entry_path = None
+        if processed and self.path is not None:
+            entry_path = os.path.join(self.path, hashlib.sha1(json.dumps(key).encode()).hexdigest() + '.png')
+            try:
+                with PIL.Image.open(entry_path) as img:
+                    img.load()
+                os.utime(entry_path) # Recently used, so evict it last
+                self.remember(key, img)
+                return img
+            except FileNotFoundError:
+                pass # Never cached, or evicted by another process
+
+        if not processed:
+            with PIL.Image.open(path) as img:
+                img = img.convert('RGBA')
+        else:
+            img = self.get(path)
+            if color is not None:
+                img = colorize_icon(img, color)
+            # Resize to fit text height
+            if max_height is not None and img.height > max_height:
+                # Can be silent about this
+                img_ratio = img.width / img.height
+                target_width = int( img_ratio * max_height )
+                img = img.resize( (target_width, max_height),
+                        resample=PIL.Image.Resampling.LANCZOS )
+
+            if entry_path is not None:
+                with atomic_write(entry_path) as tmp_path:
+                    img.save(tmp_path, format='PNG')
+                self.lru.added(entry_path)
+
+        self.remember(key, img)
+        return img
+
+def colorize_icon(img, color):
+    mask = img.getchannel('A')
+    img = PIL.ImageOps.grayscale(img)
+    img = PIL.ImageOps.colorize(img,
+            black='black',
+            mid=color,
+            white='white',
+            midpoint=COLORIZE_MIDPOINT)
+    img = img.convert('RGBA')
+    img.putalpha(mask)
+    return img
+
+# Shared by every card drawn in this process
+asset_cache = AssetCache()
+
+@lru_cache(maxsize=None)
+def load_font(name, size):
+    '''
+    Loads each font (at each size) once per process, see `find_font`
+    '''
     if os.name=="nt":
         joined_path = os.path.join(os.path.expandvars('%LocalAppData%/Microsoft/Windows/Fonts'),name)
         if os.path.isfile(joined_path):
             return PIL.ImageFont.truetype(joined_path,size)
-        else:
-            return PIL.ImageFont.truetype(name,size)
-    else:
-        return PIL.ImageFont.truetype(name,size)
+    return PIL.ImageFont.truetype(name,size)
+
+def find_font(name,size):
+    font = load_font(name, size)
+    if isinstance(font.path, str):
+        record_input(font.path)
+    return font
+
+class DataResolver:
+    '''
+    Loads card (and keyword) JSON files, flattening their `parent` chains up front.
+    Each file is only read once, until it is modified, no matter how many cards share it as a parent.
+
+    The resolved data holds every field of the chain (the closest definition wins), along with:
+    - dir: the directory of the loaded file
+    - field_dirs: for each field, the directory of the file that defined it (to resolve relative paths)
+    - sources: every file of the chain, closest first
+    '''
+    def __init__(self):
+        self.files = {} # absolute path -> ( [ (source, mtime in ns) ], resolved data )
+
+    def is_current(self, sources):
+        try:
+            return all( os.stat(source).st_mtime_ns == mtime_ns for source, mtime_ns in sources )
+        except FileNotFoundError:
+            return False
+
+    def load(self, parent_dir, file_path, children=()):
+        path = os.path.join(parent_dir, file_path)
+        key = os.path.abspath(path)
+        assert key not in children, 'Circular parent found: %s' % path
+
+        cached = self.files.get(key, None)
+        if cached is None or not self.is_current(cached[0]):
+            mtime_ns = os.stat(path).st_mtime_ns
+            with open(path, 'r') as path_fd:
+                own = json.load(path_fd)
+            cached = self.resolve(own, os.path.dirname(path), [ (key, mtime_ns) ], children + (key,))
+            self.files[key] = cached
+
+        sources, resolved = cached
+        for source, _ in sources:
+            record_input(source)
+        return dict(resolved) # Shallow copy, so the cached data is left alone
+
+    def resolve(self, own, own_dir, sources, children):
+        '''
+        Flattens the parent chain under data that was already parsed
+
+        @param sources the (path, mtime in ns) of the file `own` was read from, if any
+        @return (sources of the whole chain, resolved data)
+        '''
+        assert isinstance(own, dict), 'Expected a JSON object, not %s' % type(own).__name__
+        resolved = { 'field_dirs' : {} }
+        sources = list(sources)
+        parent = own.get('parent', None)
+        if parent is not None:
+            assert isinstance(parent, str), 'parent should be a path, not %r' % (parent,)
+            parent_data = self.load(own_dir, parent, children)
+            resolved.update(parent_data)
+            resolved['field_dirs'] = dict(parent_data['field_dirs'])
+            sources += self.files[os.path.abspath(os.path.join(own_dir, parent))][0]
+
+        resolved.update(own)
+        resolved['field_dirs'].update( (field, own_dir) for field in own )
+        resolved['dir'] = own_dir
+        resolved['sources'] = [ source for source, _ in sources ]
+        return sources, resolved
+
+    def load_inline(self, own, own_dir):
+        '''
+        Like `load`, for a card that never touched the disk (e.g. sent to `render_server.py`)
+
+        @param own_dir the directory its relative paths (parent, art...) are relative to
+        '''
+        sources, resolved = self.resolve(own, own_dir, [], ())
+        for source, _ in sources:
+            record_input(source)
+        return resolved
+
+# Shared by every card (and keyword file) loaded in this process
+data_resolver = DataResolver()
 
 def init_data(parent_dir, file_path):
-    path = os.path.join(parent_dir, file_path)
-    with open(path, 'r') as path_fd:
-        data = json.load(path_fd)
-    data['dir'] = os.path.dirname(path)
-    return data
-
-# Perhaps there could be a better interface for the additional paths...
-def get_field(data, field, relative=False, additional_paths=[]):
-    if field not in data:
-        # Resolve parent
-        parent_data = data.get('parent_data', None)
-        if parent_data is None:
-            parent = data.get('parent', None)
-            if parent is not None:
-                parent_data = init_data(data['dir'], parent)
-
-        # If a parent exists, try to get data from it
-        if parent_data is not None:
-            field_data = get_field(parent_data, field, relative)
-            if field_data is not None and relative:
-                field_data = os.path.join(os.path.dirname(data['parent']), field_data)
-            data[field] = field_data
-
-    if field in data:
-        result = data[field]
-        while result is not None and additional_paths:
-            result = result.get(additional_paths.pop(0), None)
-
-        if result is not None and relative:
-            return os.path.join(data['dir'], result)
-        return result
+    return data_resolver.load(parent_dir, file_path)
 
-    return None
+def get_field(data, field, relative=False, additional_paths=()):
+    '''
+    Gets a field of data loaded by `init_data` (parents are already resolved)
+
+    @param relative if True, the field is a path relative to the file that defined it, which is resolved
+    @param additional_paths keys to follow into nested objects of the field, e.g. `['image', 'path']`
+    '''
+    result = data.get(field, None)
+    for sub_field in additional_paths:
+        if result is None:
+            break
+        result = result.get(sub_field, None)
+
+    if result is not None and relative:
+        return os.path.join(data['field_dirs'].get(field, data['dir']), result)
+    return result
 
 def get_layer(current_layer, name, partial=False):
     if not current_layer.is_group():
@@ -168,39 +621,186 @@ def edit_page_rarity(page_rarity, data):
 
     assert found, 'No such page rarity: %s' % search
 
-def edit_page_base(psd, page_base, data):
+def check_art_pixels(art, reduction=1):
+    '''
+    Fails if art would decode to more than `ART_MAX_PIXELS`, before it is decoded
+
+    @param reduction how many times smaller each side of the art decodes at most
+    '''
+    pixels = art.width * art.height // (reduction * reduction)
+    assert pixels <= ART_MAX_PIXELS, \
+            'The art is too large to decode: %dx%d %s (at most %d million pixels decoded, and only jpegs decode smaller)' % (
+            art.width,
+            art.height,
+            art.format,
+            ART_MAX_PIXELS // (1024 * 1024))
+
+def scale_art(path, width):
+    '''
+    Loads art, resized to fit `width`.
+    Huge jpegs are decoded straight to a fraction of their size, instead of holding every pixel in memory first.
+    Other formats (e.g. png) can only be decoded whole, so art which would take more than `ART_MAX_PIXELS` fails instead.
+    '''
+    with open_image(path) as art:
+        # Always resize to fit width
+        #NOTE Could check to see if the ratio is about equal, then scale it in a different way (TODO?)
+        if art.width != width:
+            art_ratio = art.height / art.width
+            target_height =  int( width * art_ratio )
+
+            art.draft( None, (width * ART_DRAFT_GAP, target_height * ART_DRAFT_GAP) ) # Does nothing unless a jpeg
+            check_art_pixels(art) # At its drafted size
+            art = art.resize( (width, target_height),
+                    resample=PIL.Image.Resampling.LANCZOS,
+                    reducing_gap=ART_REDUCING_GAP )
+        else:
+            check_art_pixels(art)
+            art.load() # Still needed once the file is closed
+        return art
+
+class ArtCache:
+    '''
+    Card art scaled by `scale_art`, keyed by the md5 of the art (see `hash_input`) and the width it was scaled to.
+    Keeps the most recently used `max_entries` in memory, and if given a `cache_dir`,
+    persists them under `<cache_dir>/art/` so that huge art is only ever decoded once,
+    evicting the least recently used once they take up more than `max_bytes`.
+    '''
+    def __init__(self, max_entries=ART_CACHE_ENTRIES, max_bytes=ART_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = None
+        self.memory = OrderedDict()
+
+    def persist(self, cache_dir):
+        # Art is scaled by this script, so a change to it may change the art too
+        self.path = versioned_folder(os.path.join(cache_dir, 'art'), code_md5())
+        self.lru = LruFolder(self.path, self.max_bytes)
+
+    def get(self, path, width):
+        record_input(path)
+        key = ( hash_input(os.path.abspath(path))[2], width )
+        img = self.memory.get(key, None)
+        if img is not None:
+            self.memory.move_to_end(key)
+            return img
+
+        entry_path = None
+        if self.path is not None:
+            entry_path = os.path.join(self.path, '%s_%d.png' % key)
+            try:
+                with PIL.Image.open(entry_path) as img:
+                    img.load()
+                os.utime(entry_path) # Recently used, so evict it last
+            except FileNotFoundError:
+                img = None # Never cached, or evicted by another process
+
+        if img is None:
+            img = scale_art(path, width)
+            if entry_path is not None:
+                with atomic_write(entry_path) as tmp_path:
+                    img.save(tmp_path, format='PNG', compress_level=1)
+                self.lru.added(entry_path)
+
+        self.memory[key] = img
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        return img
+
+# Shared by every card drawn in this process
+art_cache = ArtCache()
+
+def load_art(data, bbox):
+    '''
+    Loads a card's art, resized to fit the width of `bbox` (the bbox of the template's sample image)
+    '''
+    return art_cache.get(get_field(data, 'art', relative=True), bbox[2] - bbox[0])
+
+def edit_page_base(psd, page_base, data, insert_art=True):
     # Not recommended to be false at the moment if not using the `-m` option
     get_layer(page_base, 'Do Not Delete').visible = get_field(data, 'grit') is not False # This is the grit
 
     sample_img_layer = get_layer(page_base, '176m2')
     sample_img_layer.visible = False # Remove default image
 
-    bbox = sample_img_layer.bbox
-    bbox_width = bbox[2] - bbox[0]
-    bbox_height = bbox[3] - bbox[1]
+    if not insert_art:
+        return None
+    return add_page_art(psd, page_base, data)
 
-    art_path = get_field(data, 'art', relative=True)
-    with PIL.Image.open(art_path) as art:
-        # Always resize to fit width
-        #NOTE Could check to see if the ratio is about equal, then scale it in a different way (TODO?)
-        if art.width != bbox_width:
-            art_ratio = art.height / art.width
-            target_height =  int( bbox_width * art_ratio )
+def add_page_art(psd, page_base, data):
+    '''
+    Inserts a card's art into the template as the lowest layer of `page_base`
+
+    @return the inserted layer, to be removed once composited
+    '''
+    bbox = get_layer(page_base, '176m2').bbox
+    page_art = PixelLayer.frompil(
+        pil_im=load_art(data, bbox),
+        psd_file=psd,
+        top=bbox[1], # Top
+        left=bbox[0], # Left
+        compression=Compression.RLE
+    )
+
+    page_base.insert(0, page_art) # Lowest in ordering
+    return page_art
+
+def art_mask(page_base, size):
+    '''
+    The opacity and masks of `page_base` and the groups above it, which the art takes on as its lowest layer
 
-            art = art.resize( (bbox_width, target_height),
-                    resample=PIL.Image.Resampling.LANCZOS )
+    @param size the size of the whole template
+    @return an 'L' image of the whole template, or None if they leave the art fully opaque
+    '''
+    mask = None
+    layer = page_base
+    while layer is not None and layer.kind != 'psdimage':
+        if layer.opacity < 255:
+            opacity = PIL.Image.new('L', size, color=layer.opacity)
+            mask = opacity if mask is None else PIL.ImageChops.multiply(mask, opacity)
+        if layer.has_mask() and not layer.mask.disabled:
+            layer_mask = PIL.Image.new('L', size, color=layer.mask.background_color)
+            layer_mask.paste(layer.mask.topil(), (layer.mask.left, layer.mask.top))
+            mask = layer_mask if mask is None else PIL.ImageChops.multiply(mask, layer_mask)
+        layer = layer.parent
+    return mask
+
+def blended_layers(art_layer):
+    '''
+    Finds what `place_art` can't put the art underneath: layers composited over `art_layer` (later in its group,
+    or in any group holding it, and everything inside those), or groups holding it, which don't blend Normally.
+    Visibility is ignored, as cards toggle it.
 
-        page_art = PixelLayer.frompil(
-            pil_im=art,
-            psd_file=psd,
-            top=bbox[1], # Top
-            left=bbox[0], # Left
-            compression=Compression.RLE
-        )
+    @return a list of their names
+    '''
+    blended = []
+    layer = art_layer
+    while layer.parent is not None:
+        group = layer.parent
+        siblings = list(group)
+        for above in siblings[siblings.index(layer) + 1:]:
+            for candidate in [ above ] + (list(above.descendants()) if above.is_group() else []):
+                if candidate.blend_mode not in (None, BlendMode.NORMAL, BlendMode.PASS_THROUGH):
+                    blended.append(candidate.name)
+        if group.kind != 'psdimage' and group.blend_mode not in (None, BlendMode.NORMAL, BlendMode.PASS_THROUGH):
+            blended.append(group.name)
+        layer = group
+    return blended
+
+def place_art(base, art, bbox, mask=None):
+    '''
+    Puts a card's art (from `load_art`) underneath a template composited without it, as `add_page_art` would have
 
-        page_base.insert(0, page_art) # Lowest in ordering
+    @param mask Optional. The `art_mask` of the template
+    '''
+    # The art is the lowest layer, so everything else goes over it
+    img = PIL.Image.new('RGBA', base.size, color=(0,0,0,0))
+    img.paste(art.convert('RGBA'), (bbox[0], bbox[1]))
+    if mask is not None:
+        img.putalpha(PIL.ImageChops.multiply(img.getchannel('A'), mask))
+    img.alpha_composite(base)
+    return img
 
-def edit_combat_page(psd, combat_page, data):
+def edit_combat_page(psd, combat_page, data, insert_art=True):
     # No need for notes
     get_layer(combat_page, 'Notes', partial=True).visible = False
     # Doing this ourselves in PIL
@@ -208,28 +808,48 @@ def edit_combat_page(psd, combat_page, data):
 
     edit_dice_number(get_layer(combat_page, 'Number of Dice'), data)
     edit_page_rarity(get_layer(combat_page, 'Card Rarity'), data)
-    edit_page_base(psd, get_layer(combat_page, 'Card Base', partial=True), data)
+    return edit_page_base(psd, get_layer(combat_page, 'Card Base', partial=True), data, insert_art)
 
-def edit_page_class(psd, data):
+def edit_page_class(psd, data, insert_art=True):
     # No support for abno pages yet
     get_layer(psd, 'Abnormality Pages').visible = False
 
     combat_page = get_layer(psd, 'Combat Pages')
     combat_page.visible = True
-    edit_combat_page(psd, combat_page, data)
+    return edit_combat_page(psd, combat_page, data, insert_art)
 
-def add_title(img, data):
-    # Strategy: Create a new image, draw text, rotate, draw over
-    # Need to do it on another image to gain access to a rotate() function
+# (name, font, size, card size) -> (rotated title, position), shared by every card drawn in this process
+title_layers = {}
 
-    # To be safe, just create an image the size of the original
-    text_layer = PIL.Image.new('RGBA', (img.width, img.height), color=(0,0,0,0))
-    draw = PIL.ImageDraw.Draw(text_layer)
-    font = find_font(TITLE_TEXT_FONT, TITLE_TEXT_SIZE)
+def title_layer(name, font, size):
+    '''
+    Draws and rotates a title on a layer just big enough to hold it, instead of one the size of the whole card
 
+    @param size the size of the card
+    @return (the layer, the position of its top left corner on the card)
+    '''
     center = ( TITLE_CENTER_X, TITLE_CENTER_Y )
-    draw.multiline_text( center,
-            get_field(data, 'name'),
+    draw = PIL.ImageDraw.Draw( PIL.Image.new('RGBA', (1, 1)) )
+    left, top, right, bottom = draw.multiline_textbbox( center, name, font=font, anchor='ms' )
+
+    # The layer has to hold the text both before it turns (or it is cut off while drawing) and after,
+    # so it reaches as far from the center as either (plus a pixel on each side for bilinear filtering)
+    half_width = max( abs(left - center[0]), abs(right - center[0]) )
+    half_height = max( abs(top - center[1]), abs(bottom - center[1]) )
+    angle = radians(TITLE_ANGLE_DEG)
+    reach_x = max( half_width, half_width * abs(cos(angle)) + half_height * abs(sin(angle)) ) + 2
+    reach_y = max( half_height, half_width * abs(sin(angle)) + half_height * abs(cos(angle)) ) + 2
+    box = ( max(0, floor(center[0] - reach_x)),
+            max(0, floor(center[1] - reach_y)),
+            min(size[0], ceil(center[0] + reach_x)),
+            min(size[1], ceil(center[1] + reach_y)) )
+
+    # Drawn and rotated around the same center as on the whole card, so every pixel comes out the same
+    local_center = ( center[0] - box[0], center[1] - box[1] )
+    text_layer = PIL.Image.new('RGBA', (max(box[2] - box[0], 0), max(box[3] - box[1], 0)), color=(0,0,0,0))
+    draw = PIL.ImageDraw.Draw(text_layer)
+    draw.multiline_text( local_center,
+            name,
             font=font,
             anchor='ms',
             fill=COLOR_TITLE )
@@ -237,21 +857,35 @@ def add_title(img, data):
     # Slightly rotate the text to fix the banner
     text_layer = text_layer.rotate( TITLE_ANGLE_DEG,
             resample=PIL.Image.Resampling.BILINEAR,
-            center=center )
+            center=local_center )
+    return text_layer, box[:2]
 
-    return PIL.Image.alpha_composite( img, text_layer )
+def add_title(img, data):
+    # Draws onto `img` itself, like `add_cost` and `add_text`
+    # Strategy: Draw the text on its own layer, rotate, draw over
+    # Need to do it on another image to gain access to a rotate() function
+    font = find_font(TITLE_TEXT_FONT, TITLE_TEXT_SIZE)
+    name = get_field(data, 'name')
+
+    # Many cards share a name (e.g. across variants or folders), so each is only rotated once
+    key = ( name, font.path, font.size, img.size )
+    cached = title_layers.get(key, None)
+    if cached is None:
+        if len(title_layers) >= TITLE_ENTRIES:
+            title_layers.clear()
+        cached = title_layer(name, font, img.size)
+        title_layers[key] = cached
+
+    text_layer, position = cached
+    if text_layer.width and text_layer.height:
+        img.alpha_composite( text_layer, dest=position )
+    return img
 
 def add_cost( asset_path, img, data ):
     draw = PIL.ImageDraw.Draw( img )
     font = find_font( COST_TEXT_FONT, COST_TEXT_SIZE )
 
-    cost_grit_path, cost_grit_stroke_fill = {
-            'paperback' : ('cost_grit_paperback.png', '#9FE195'),
-            'hardcover' : ('cost_grit_hardcover.png', '#9FC3EF'),
-            'limited' : ('cost_grit_limited.png', '#B78BE5'),
-            "objet d'art" : ('cost_grit_objet.png', '#FFCB69'),
-            'e.g.o' : ('cost_grit_ego.png', '#FFFFDB'),
-            }[get_field(data, 'rarity').lower()]
+    cost_grit_path, cost_grit_stroke_fill = RARITIES[get_field(data, 'rarity').lower()]
 
     cost_grit_path = os.path.join( asset_path, 'cost_grit', cost_grit_path )
             
@@ -263,7 +897,7 @@ def add_cost( asset_path, img, data ):
         stroke_fill=cost_grit_stroke_fill )
 
     if get_field( data, 'grit' ) is not False:
-        img.alpha_composite( PIL.Image.open(cost_grit_path).convert('RGBA') ) 
+        img.alpha_composite( asset_cache.get(cost_grit_path) )
 
     return img
 
@@ -273,55 +907,238 @@ class KeywordData(Enum):
     IMAGE = 2
     BREAK = 3
 
-def get_keywords( text, keyword_data ):
+def split_keywords( text ):
     '''
-    Gets an array of regular text interwoven with keywords + metadata
+    Splits text into plain text and `{keyword}` names, in a single pass over it
 
-    @param text the text to get keywords from
-    @param keyword_data a dictionary object obtained from an `init_data` call
-    @return An array with tuple objects, where the first element is a `KeywordData` enum.
-    This contextualizes the other elements of the tuple.
-    For ease, all text is broken up by splitting on whitespace (to enable word wrapping later)
+    @return a generator of (is a keyword, plain text or keyword name) tuples
     '''
-    result = []
+    position = 0
     while True:
-        start = text.find('{')
-        end = text.find('}')
+        start = text.find('{', position)
+        end = text.find('}', position)
 
         # No more keywords, the rest is plain text
         if start < 0 or end < 0:
-            if len(text) != 0:
-                result += [ (KeywordData.REGULAR, word + ' ') for word in text.split() ]
-            return result
-        else:
-            # Keyword found
+            if position < len(text):
+                yield False, text[position:]
+            return
 
-            # Append the text before as plain text
-            if start > 0:
-                result += [ (KeywordData.REGULAR, word + ' ') for word in text[:start].split() ]
+        # Keyword found, after some plain text
+        if start > position:
+            yield False, text[position:start]
+        yield True, text[start + 1:end]
+        position = end + 1
 
-            kw = text[start + 1:end]
-            kw_data = get_field( keyword_data, kw )
-            assert kw_data is not None, 'The keyword "%s" was not found in the keyword dictionary!' % kw
+class KeywordIndex:
+    '''
+    A keyword dictionary (see `assets/keywords.json`), compiled once into the tokens each keyword expands to
+    (see `get_keywords`), with icon paths resolved and colours and line breaks applied.
+    Texts are tokenised in a single pass, and the most recent `TOKEN_ENTRIES` are kept, as many repeat across cards.
 
+    @param keyword_data a dictionary object obtained from an `init_data` call
+    '''
+    def __init__(self, keyword_data):
+        self.sources = data_resolver.files[keyword_data['sources'][0]][0] # (path, mtime in ns) of every file
+        self.keywords = {} # keyword -> tokens
+        self.errors = {} # keyword -> why it can't be used
+        self.texts = {}
+
+        for kw, kw_data in keyword_data.items():
+            if kw in ('parent', 'dir', 'field_dirs', 'sources') or not isinstance(kw_data, dict):
+                continue # Not a keyword
+
+            tokens = []
             if 'image' in kw_data:
-                kw_img = PIL.Image.open( get_field(keyword_data,
+                kw_img_path = get_field(keyword_data,
                         kw,
                         relative=True,
-                        additional_paths=['image', 'path']) )
+                        additional_paths=['image', 'path'])
+                if kw_img_path is None:
+                    self.errors[kw] = 'The keyword "%s" has an image without a path' % kw
+                    continue
                 kw_cc = kw_data['image'].get( 'convert_color', False )
-                result.append( (KeywordData.IMAGE, kw_img, kw_cc) )
+                # Absolute, as the index may be cached and loaded again from another working directory
+                tokens.append( (KeywordData.IMAGE, os.path.abspath(kw_img_path), kw_cc) )
 
             if 'text' in kw_data:
+                if 'content' not in kw_data['text']:
+                    self.errors[kw] = 'The keyword "%s" has text without any content' % kw
+                    continue
                 text_content = kw_data['text']['content']
                 text_color = kw_data['text'].get('color', None)
-                result += [ (KeywordData.SPECIAL, word + ' ', text_color)
+                tokens += [ (KeywordData.SPECIAL, word + ' ', text_color)
                         for word in text_content.split() ]
 
                 # Kind of hacky- needed for certain special keywords e.g. summation
                 if text_content.endswith('\n'):
-                    result += [ (KeywordData.BREAK,) ]
-            text = text[end + 1:]
+                    tokens += [ (KeywordData.BREAK,) ]
+            self.keywords[kw] = tuple(tokens)
+
+    def state(self):
+        '''
+        @return the index as plain data, to be cached. Pickling the index itself would record its classes by module,
+        which is `__main__` when this script is run, but `generate_card` when imported (e.g. by `render_server.py`),
+        and the tokens of one never compare equal to those of the other
+        '''
+        return {
+            'sources' : self.sources,
+            'errors' : self.errors,
+            'keywords' : { kw : [ (token[0].value,) + token[1:] for token in tokens ] for kw, tokens in self.keywords.items() },
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.sources = state['sources']
+        index.errors = state['errors']
+        index.keywords = { kw : tuple( (KeywordData(token[0]),) + token[1:] for token in tokens )
+                for kw, tokens in state['keywords'].items() }
+        index.texts = {} # Tokenised texts are only worth keeping for the life of a process
+        return index
+
+    def tokens(self, kw):
+        assert kw not in self.errors, self.errors.get(kw, None)
+        tokens = self.keywords.get(kw, None)
+        assert tokens is not None, 'The keyword "%s" was not found in the keyword dictionary!' % kw
+        return tokens
+
+    def tokenize(self, text):
+        tokens = self.texts.get(text, None)
+        if tokens is None:
+            result = []
+            for is_keyword, content in split_keywords(text):
+                if is_keyword:
+                    result += self.tokens(content)
+                else:
+                    result += [ (KeywordData.REGULAR, word + ' ') for word in content.split() ]
+            tokens = tuple(result)
+
+            if len(self.texts) >= TOKEN_ENTRIES:
+                self.texts.clear()
+            self.texts[text] = tokens
+        return tokens
+
+# Keyword indexes already loaded by this process (e.g. to validate cards, then to render them), by absolute path
+keyword_indexes = {}
+
+def load_keywords(keyword_path, cache_dir=None):
+    '''
+    Loads a keyword dictionary into a `KeywordIndex`.
+    The index is kept for the life of the process, and if given a `cache_dir`, also in `<cache_dir>/keywords/`
+    (see `KeywordIndex.state`), under the md5 of this script as a change to it may change the index.
+    Either is reused for as long as none of the keyword files (the file and its parents) change.
+    '''
+    key = os.path.abspath(keyword_path)
+    index = keyword_indexes.get(key, None)
+    if index is not None and data_resolver.is_current(index.sources):
+        for source, _ in index.sources:
+            record_input(source)
+        return index
+
+    entry_path = None
+    if cache_dir is not None:
+        entry_dir = versioned_folder(os.path.join(cache_dir, 'keywords'), code_md5())
+        entry_path = os.path.join(entry_dir, hashlib.sha1(key.encode()).hexdigest() + '.pickle')
+        try:
+            with open(entry_path, 'rb') as entry_fd:
+                index = KeywordIndex.from_state(pickle.load(entry_fd))
+            if data_resolver.is_current(index.sources):
+                for source, _ in index.sources:
+                    record_input(source)
+                keyword_indexes[key] = index
+                return index
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, TypeError, KeyError, ValueError):
+            pass # Never cached, or unreadable
+
+    index = KeywordIndex(init_data('', keyword_path))
+    if entry_path is not None:
+        with atomic_write(entry_path) as tmp_path, open(tmp_path, 'wb') as entry_fd:
+            pickle.dump(index.state(), entry_fd, protocol=pickle.HIGHEST_PROTOCOL)
+    keyword_indexes[key] = index
+    return index
+
+def get_keywords( text, keywords ):
+    '''
+    Gets an array of regular text interwoven with keywords + metadata
+
+    @param text the text to get keywords from
+    @param keywords a `KeywordIndex`
+    @return An array with tuple objects, where the first element is a `KeywordData` enum.
+    Images are given by path, to be loaded through the `asset_cache`.
+    This contextualizes the other elements of the tuple.
+    For ease, all text is broken up by splitting on whitespace (to enable word wrapping later)
+    '''
+    return keywords.tokenize(text)
+
+# (font, size, font mode, text) -> width in pixels, shared by every card drawn in this process
+text_widths = {}
+
+def keyword_width( kw, draw, font ):
+    '''
+    Measures one keyword element (returned by `get_keywords`), as it is measured for word wrapping
+    Text is only measured once per font, no matter how often (or in which color) it is drawn.
+    '''
+    kw_type = kw[0]
+    if kw_type == KeywordData.BREAK:
+        return 0
+    if kw_type == KeywordData.IMAGE:
+        # Images are measured at their original size, before `draw_keywords` shrinks them to fit the text
+        return asset_cache.get(kw[1]).width
+
+    key = ( font.path, font.size, draw.fontmode, kw[1] )
+    width = text_widths.get(key, None)
+    if width is None:
+        if len(text_widths) >= TEXT_WIDTH_ENTRIES:
+            text_widths.clear()
+        width = int( ceil(draw.textlength( kw[1], font )) )
+        text_widths[key] = width
+    return width
+
+# (font, size, font mode, text) -> (mask, offset from the text's position), shared by every card drawn in this process
+word_masks = {}
+
+def draw_word( img, draw, font, position, text, color ):
+    '''
+    Draws text as `draw.text` would, but rasterises each word (in each font) only once and then pastes it.
+    Description text is mostly the same few words and keywords over and over.
+    '''
+    if WORD_MASK_ENTRIES <= 0:
+        draw.text( position, text, font=font, fill=color )
+        return
+
+    key = ( font.path, font.size, draw.fontmode, text )
+    cached = word_masks.get(key, None)
+    if cached is None:
+        if len(word_masks) >= WORD_MASK_ENTRIES:
+            word_masks.clear()
+        left, top, right, bottom = font.getbbox( text, mode=draw.fontmode )
+        mask = PIL.Image.new('L', (max(right - left, 0), max(bottom - top, 0)))
+        mask_draw = PIL.ImageDraw.Draw(mask)
+        mask_draw.fontmode = draw.fontmode
+        mask_draw.text( (-left, -top), text, font=font, fill=255 )
+        cached = ( mask, (left, top) )
+        word_masks[key] = cached
+
+    mask, offset = cached
+    if mask.width and mask.height:
+        img.paste( PIL.ImageColor.getcolor(color, img.mode),
+                (position[0] + offset[0], position[1] + offset[1]),
+                mask )
+
+class LineLayout:
+    '''
+    A single line of keywords (returned by `get_keywords`), measured once and then drawn with `draw_keywords`
+
+    @param keywords the keywords on this line
+    @param width the width of the line in pixels, as measured by `keyword_width`
+    '''
+    def __init__(self, keywords, width):
+        self.keywords = keywords
+        self.width = width
+
+def layout_line( draw, font, keywords ):
+    return LineLayout(keywords, sum( keyword_width(kw, draw, font) for kw in keywords ))
 
 def draw_keywords( keywords, draw, font, img=None, position=(0,0), default_color=COLOR_DESC, query_width=True ):
     '''
@@ -343,26 +1160,14 @@ def draw_keywords( keywords, draw, font, img=None, position=(0,0), default_color
         if kw_type == KeywordData.BREAK:
             continue
         if kw_type == KeywordData.IMAGE:
-            data_img, data_cc = kw[1:]
-            if not query_width:
-                if data_cc:
-                    mask = data_img.getchannel('A')
-                    data_img = PIL.ImageOps.grayscale(data_img)
-                    data_img = PIL.ImageOps.colorize(data_img,
-                            black='black',
-                            mid=default_color,
-                            white='white',
-                            midpoint=COLORIZE_MIDPOINT)
-                    data_img = data_img.convert('RGBA')
-                    data_img.putalpha(mask)
-
-                # Resize to fit text height
-                if data_img.height > font_ascent:
-                    # Can be silent about this
-                    img_ratio = data_img.width / data_img.height
-                    target_width = int( img_ratio * font_ascent )
-                    data_img = data_img.resize( (target_width, font_ascent),
-                            resample=PIL.Image.Resampling.LANCZOS )
+            data_path, data_cc = kw[1:]
+            if query_width:
+                data_img = asset_cache.get(data_path)
+            else:
+                # Color converted, then resized to fit text height
+                data_img = asset_cache.get(data_path,
+                        max_height=font_ascent,
+                        color=default_color if data_cc else None)
                 # Center it vertically
                 img_y = position[1] + ( (font_ascent + font_descent) // 2 ) - ( data_img.height // 2 )
                 # Draw
@@ -381,58 +1186,54 @@ def draw_keywords( keywords, draw, font, img=None, position=(0,0), default_color
                 if color is None:
                     color = COLOR_KEYWORD
             if not query_width:
-                draw.text( ( position[0] + width, position[1]),
-                        text,
-                        font=font,
-                        fill=color )
-            width += int( ceil(draw.textlength( text, font )) )
+                draw_word( img, draw, font, ( position[0] + width, position[1]), text, color )
+            width += keyword_width( kw, draw, font )
     return width
 
 def wrap_keywords( draw, font, keywords, width ):
     '''
-    Wraps an array of keywords (returned by `get_keywords`) into a 2D array.
-    Each entry of the 2D array represents a single line which fits in the specified width.
+    Wraps an array of keywords (returned by `get_keywords`) into lines, in a single pass.
+    Each line fits in the specified width.
 
     @param draw a PIL.ImageDraw instance
     @param font the font to draw in
-    @param keywords an array of keyworsd, returne by `get_keywords`
+    @param keywords an array of keywords, returned by `get_keywords`
     @param width the width to perform word wrap on.
 
-    @return a 2D array of keywords
+    @return an array of `LineLayout`
     '''
     wrapped = []
     current = []
+    current_width = 0
 
     for kw in keywords:
         if kw[0] == KeywordData.BREAK:
             if len(current) != 0:
-                wrapped.append(current)
+                wrapped.append( LineLayout(current, current_width) )
                 current = []
+                current_width = 0
             continue
 
-        if len(current) == 0:
-            delta = [ kw ]
-        else:
-            delta = current + [ kw ]
-
-        # Use `draw_keywords` to query the width of the next (delta) addition
-        if draw_keywords( delta, draw, font ) > width:
+        kw_width = keyword_width( kw, draw, font )
+        if current_width + kw_width > width:
             # Always draw at least 1 keyword element, otherwise we are stuck
             if len(current) == 0:
-                wrapped.append(delta)
+                wrapped.append( LineLayout([ kw ], kw_width) )
             else:
-                wrapped.append(current)
+                wrapped.append( LineLayout(current, current_width) )
                 current = [ kw ]
+                current_width = kw_width
         else:
-            current = delta
+            current.append( kw )
+            current_width += kw_width
 
     # Don't forget the last line!
     if len(current) != 0:
-        wrapped.append(current)
+        wrapped.append( LineLayout(current, current_width) )
 
     return wrapped
 
-def add_text( asset_path, keyword_data, img, data ):
+def add_text( asset_path, keywords, img, data ):
     draw = PIL.ImageDraw.Draw( img )
     font = find_font( DESC_TEXT_FONT, DESC_TEXT_SIZE )
     font_ascent, font_descent = font.getmetrics()
@@ -441,10 +1242,10 @@ def add_text( asset_path, keyword_data, img, data ):
     preamble = get_field( data, 'preamble' )
     current_offset_y = TEXT_UP
     if preamble:
-        preamble = get_keywords( preamble, keyword_data )
+        preamble = get_keywords( preamble, keywords )
         preamble = wrap_keywords( draw, font, preamble, TEXT_RIGHT - TEXT_LEFT )
-        for keywords in preamble:
-            draw_keywords( keywords,
+        for line in preamble:
+            draw_keywords( line.keywords,
                     draw,
                     font,
                     img=img,
@@ -463,20 +1264,20 @@ def add_text( asset_path, keyword_data, img, data ):
             dice_color = COLOR_OFFENSE
 
         dice_img_path = os.path.join( asset_path, 'ruina', dice_type + '.png' )
-        dice_img = PIL.Image.open( dice_img_path )
+        dice_img = asset_cache.get( dice_img_path )
 
         height = 0
-        dice_range = get_keywords( dice['range'], keyword_data )
+        dice_range = layout_line( draw, font, get_keywords( dice['range'], keywords ) )
         dice_effect = dice.get('effect', None)
         if dice_effect:
-            dice_effect = get_keywords( dice_effect, keyword_data )
-            effect_offset_x = dice_img.width + draw_keywords( dice_range, draw, font ) + TEXT_SPACER + TEXT_LEFT
+            dice_effect = get_keywords( dice_effect, keywords )
+            effect_offset_x = dice_img.width + dice_range.width + TEXT_SPACER + TEXT_LEFT
             dice_effect = wrap_keywords( draw,
                     font,
                     dice_effect,
                     TEXT_RIGHT - effect_offset_x )
-            for keywords in dice_effect:
-                draw_keywords( keywords,
+            for line in dice_effect:
+                draw_keywords( line.keywords,
                         draw,
                         font,
                         img=img,
@@ -491,7 +1292,7 @@ def add_text( asset_path, keyword_data, img, data ):
                 height = dice_img.height
 
         # Draw range
-        draw_keywords( dice_range,
+        draw_keywords( dice_range.keywords,
             draw,
             font,
             img=img,
@@ -508,48 +1309,1193 @@ def add_text( asset_path, keyword_data, img, data ):
 
     return img
 
-def main(data_path, output_path, asset_path, keyword_path, is_mini=False):
-    psd_path = os.path.join(asset_path, PSD_NAME)
-    with open(psd_path, 'rb') as check_psd:
-        check_md5 = hashlib.file_digest(check_psd, 'md5').hexdigest()
-        assert check_md5 == PSD_MD5, \
-                'MD5 sum for %s did not match expected (%s!=%s), wrong psd supplied!' % (psd_path,
-                check_md5,
-                PSD_MD5)
+def save_image(img, output_path, variant, encoding=ENCODING):
+    '''
+    Encodes one output of a card
+
+    @param variant one of `VARIANTS`
+    @param encoding a dictionary of options, see `ENCODING`
+    '''
+    if encoding['format'] == 'webp':
+        img.save(output_path,
+                format='WEBP',
+                lossless=encoding['webp_lossless'],
+                quality=encoding['webp_quality'],
+                method=encoding['webp_method'])
+        return
+
+    if variant == 'mini' and encoding['quantize_mini']:
+        # Minis are small and flat enough to survive a palette
+        img = img.quantize(colors=encoding['quantize_mini'], method=PIL.Image.Quantize.FASTOCTREE)
+
+    options = {}
+    if encoding['png_compress_level'] is not None:
+        options['compress_level'] = encoding['png_compress_level']
+    if encoding['png_strategy'] is not None:
+        options['compress_type'] = PNG_STRATEGIES[encoding['png_strategy']]
+    img.save(output_path, format='PNG', **options)
+
+def file_md5(path):
+    with open(path, 'rb') as path_fd:
+        return hashlib.file_digest(path_fd, 'md5').hexdigest()
+
+class HashCache:
+    '''
+    md5s of files, only recomputed when the file's (size, modified time, inode) change.
+    Every md5 is kept for the life of the process. If given a `cache_dir`, those of large files (the psd, big art)
+    are also kept in `<cache_dir>/hashes.json`, so that later runs don't read them through again.
+    '''
+    def __init__(self):
+        self.hashes = {} # absolute path -> [size, mtime in ns, inode, md5]
+        self.path = None
+
+    def persist(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'hashes.json')
+        self.hashes.update(self.load())
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as hashes_fd:
+                return json.load(hashes_fd)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def md5(self, path, strict=False):
+        '''
+        @param strict always read the file through, in case it changed without its size or modified time changing
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        fingerprint = [ stat.st_size, stat.st_mtime_ns, stat.st_ino ]
+        entry = self.hashes.get(path, None)
+        if not strict and entry is not None and entry[:3] == fingerprint:
+            return entry[3]
+
+        md5 = file_md5(path)
+        self.hashes[path] = fingerprint + [ md5 ]
+        if self.path is not None and stat.st_size >= HASH_PERSIST_BYTES:
+            # Merged with what other processes saved meanwhile
+            hashes = self.load()
+            hashes[path] = self.hashes[path]
+            with atomic_write(self.path) as tmp_path, open(tmp_path, 'w') as hashes_fd:
+                json.dump(hashes, hashes_fd)
+        return md5
+
+# Shared by everything hashed in this process: the psd, and every input recorded in a `Manifest`
+hash_cache = HashCache()
+
+def verify_psd(psd_path, strict=False):
+    '''
+    Checks that the psd is the one this script was written for, see `HashCache` for `strict`
+    '''
+    check_md5 = hash_cache.md5(psd_path, strict)
+    assert check_md5 == PSD_MD5, \
+            'MD5 sum for %s did not match expected (%s!=%s), wrong psd supplied!' % (psd_path,
+            check_md5,
+            PSD_MD5)
+
+def open_psd(psd_path, cache_dir=None, strict=False):
+    '''
+    Parses the (verified) psd. If given a `cache_dir`, the parsed layer tree is pickled in `<cache_dir>/psd/`,
+    which loads several times faster than parsing, and is reused for as long as the psd is unchanged
+    '''
+    if cache_dir is None:
+        return PSDImage.open(psd_path)
+
+    entry_dir = os.path.join(cache_dir, 'psd')
+    os.makedirs(entry_dir, exist_ok=True)
+    # Pickles are only good for the version of psd-tools that made them
+    entry_path = os.path.join(entry_dir, '%s_%s.pickle' % (PSD_MD5, psd_tools.__version__))
+    stat = os.stat(psd_path)
+    fingerprint = [ os.path.abspath(psd_path), stat.st_size, stat.st_mtime_ns, stat.st_ino ]
+    if not strict:
+        try:
+            with open(entry_path, 'rb') as entry_fd:
+                entry_fingerprint, psd = pickle.load(entry_fd)
+            if entry_fingerprint == fingerprint:
+                return psd
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, TypeError, ValueError):
+            pass # Never cached, or unreadable
+
     psd = PSDImage.open(psd_path)
-    data = init_data('', data_path)
-    keyword_data = init_data('', keyword_path)
+    with atomic_write(entry_path) as tmp_path, open(tmp_path, 'wb') as entry_fd:
+        pickle.dump( (fingerprint, psd), entry_fd, protocol=pickle.HIGHEST_PROTOCOL )
+    return psd
+
+def hash_input(path):
+    '''
+    @return a [size, mtime in ns, md5] fingerprint of an input file, as stored in a `Manifest`
+    '''
+    stat = os.stat(path)
+    return [ stat.st_size, stat.st_mtime_ns, hash_cache.md5(path) ]
+
+def code_md5():
+    '''
+    @return the md5 of this script, which the caches keep their entries under, as changing it may change what they hold
+    '''
+    return hash_cache.md5(__file__)
 
-    # Toggle layers
-    edit_page_class(psd, data)
+class Manifest:
+    '''
+    Remembers every input file (and its fingerprint, see `hash_input`) that each output of a batch was rendered from,
+    including the parents of cards and keyword files, art, icons, fonts and the template.
+    A rebuild then only needs to render the outputs whose inputs changed.
+    '''
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as path_fd:
+                self.outputs = json.load(path_fd)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.outputs = {}
+
+    def is_current(self, output_path, options=None):
+        '''
+        @param options the options the output would be rendered with now (e.g. its encoding), which must not have changed either
+        '''
+        entry = self.outputs.get(os.path.abspath(output_path), None)
+        if entry is None or not os.path.isfile(output_path) or entry.get('options', None) != options:
+            return False
+
+        inputs = entry['inputs']
+        for path, (size, mtime_ns, md5) in inputs.items():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return False
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                # Only touched? Then remember the new time, to skip hashing it next time
+                fingerprint = hash_input(path)
+                if fingerprint[2] != md5:
+                    return False
+                inputs[path] = fingerprint
+        return True
+
+    def record(self, output_path, inputs, options=None):
+        self.outputs[os.path.abspath(output_path)] = { 'inputs' : inputs, 'options' : options }
+
+    def save(self):
+        # Forget about outputs which were deleted since
+        self.outputs = { output : entry for output, entry in self.outputs.items() if os.path.isfile(output) }
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with atomic_write(self.path) as tmp_path, open(tmp_path, 'w') as tmp_fd:
+            json.dump(self.outputs, tmp_fd, indent=1, sort_keys=True)
+
+def template_key(data):
+    '''
+    Everything about a card that decides which layers of the template are visible (see `edit_page_class`)
+    Cards with the same key composite to the same image, besides their art.
+    '''
+    return ( get_field(data, 'type').lower(),
+            get_field(data, 'rarity').lower(),
+            tuple( dice['type'].lower() for dice in get_field(data, 'dice') ),
+            get_field(data, 'grit') is not False )
 
-    # Force redraws the psd instead of grabbing from the cache / buf
-    img = psd.composite(force=True)
+class CardTemplate:
+    '''
+    The template psd, verified and parsed once so that it can be reused for many cards.
+    Every card toggles layer visibility and inserts its own art, so the template remembers
+    the visibility it was loaded with and restores it with `reset` before the next card.
+    '''
+    def __init__(self, asset_path, cache_dir=None, strict=False):
+        self.path = os.path.join(asset_path, PSD_NAME)
+        with profile_stage('verify'):
+            verify_psd(self.path, strict)
+        with profile_stage('open'):
+            self.psd = open_psd(self.path, cache_dir, strict)
+        self.visibility = [ (layer, layer.visible) for layer in self.psd.descendants() ]
+
+        self.page_base = get_layer(get_layer(self.psd, 'Combat Pages'), 'Card Base', partial=True)
+        self.art_bbox = get_layer(self.page_base, '176m2').bbox
+        self.art_mask = art_mask(self.page_base, self.psd.size)
+        self.art_blends = blended_layers(get_layer(self.page_base, '176m2'))
+
+    def reset(self):
+        for layer, visible in self.visibility:
+            # Setting visibility makes psd-tools recompute the bbox of every group above, so only touch what changed
+            if layer.visible != visible:
+                layer.visible = visible
+
+class TemplateCache:
+    '''
+    A persistent cache of composited templates without any art, keyed by `template_key`.
+    Entries live in `<cache_dir>/templates/<psd md5>_<script md5>/`, so a changed template (or a change to how
+    this script toggles its layers) never reuses stale entries,
+    and the least recently used entries are evicted once the cache grows past `max_bytes`.
+    '''
+    def __init__(self, cache_dir, max_bytes=TEMPLATE_CACHE_BYTES, md5=PSD_MD5):
+        self.path = versioned_folder(os.path.join(cache_dir, 'templates'), '%s_%s' % (md5, code_md5()))
+        self.lru = LruFolder(self.path, max_bytes)
+        self.memory = OrderedDict()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(json.dumps(key).encode()).hexdigest() + '.png')
+
+    def remember(self, key, img):
+        self.memory[key] = img
+        self.memory.move_to_end(key)
+        while len(self.memory) > TEMPLATE_CACHE_MEMORY:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        path = self.entry_path(key)
+        try:
+            with PIL.Image.open(path) as img:
+                img.load()
+            os.utime(path) # Recently used, so evict it last
+        except FileNotFoundError:
+            return None # Never cached, or evicted by another process
+        self.remember(key, img)
+        return img
+
+    def put(self, key, img):
+        self.remember(key, img)
+        path = self.entry_path(key)
+        with atomic_write(path) as tmp_path:
+            img.save(tmp_path, format='PNG', compress_level=1)
+        self.lru.added(path)
+
+def link_or_copy(source, destination):
+    '''
+    Hardlinks `destination` to `source` (replacing it), or copies it where links aren't possible (e.g. across drives)
+    '''
+    with atomic_write(destination) as tmp_path:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
 
-    # Add custom title and text
-    img = add_title( img, data )
-    img = add_cost( asset_path, img, data )
+class OutputStore:
+    '''
+    A content addressed store of rendered outputs, in `<cache_dir>/outputs/`.
+    Each is named after the hash of everything its variant was rendered from (see `CardRenderer.output_digest`),
+    so an output which would come out the same as one rendered before (e.g. a mini after editing the card's text,
+    or the same card in another folder) is linked to it instead of rendered again.
+    The least recently used entries are evicted once the store grows past `max_bytes`.
+    '''
+    def __init__(self, cache_dir, max_bytes=OUTPUT_STORE_BYTES):
+        self.path = os.path.join(cache_dir, 'outputs')
+        os.makedirs(self.path, exist_ok=True)
+        self.lru = LruFolder(self.path, max_bytes)
+
+    def entry_path(self, digest, output_path):
+        return os.path.join(self.path, digest + os.path.splitext(output_path)[1])
+
+    def get(self, digest, output_path):
+        '''
+        @return whether `output_path` could be linked to a stored output
+        '''
+        entry = self.entry_path(digest, output_path)
+        try:
+            os.utime(entry) # Recently used, so evict it last
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            link_or_copy(entry, output_path)
+        except FileNotFoundError:
+            return False # Never stored, or evicted by another process
+        return True
+
+    def put(self, digest, output_path):
+        entry = self.entry_path(digest, output_path)
+        link_or_copy(output_path, entry)
+        self.lru.added(entry)
+
+class CardRenderer:
+    '''
+    Holds everything that can be shared between cards (the template, the keyword dictionary, caches).
+    Create one of these and call `render` for each card instead of calling `main` repeatedly.
+    '''
+    def __init__(self, asset_path, keyword_path, cache_dir=None, template_cache_bytes=TEMPLATE_CACHE_BYTES,
+            encoding=ENCODING, encode_threads=0, art_mode='pil', verify_strict=False, store_outputs=True):
+        assert art_mode in ART_MODES, 'No such art mode: %s' % art_mode
+        self.asset_path = asset_path
+        self.art_mode = art_mode
+        self.encoding = encoding
+        # Encoding in the background lets the next card be composed meanwhile, see `render`
+        self.encoder = ThreadPoolExecutor(encode_threads) if encode_threads > 0 else None
+        if cache_dir is not None:
+            hash_cache.persist(cache_dir)
+        with track_inputs() as fixed_inputs:
+            self.template = CardTemplate(asset_path, cache_dir, verify_strict)
+            record_input(self.template.path)
+            if self.art_mode == 'pil' and self.template.art_blends:
+                # Blending the art with those layers is up to psd-tools
+                print('Layers over the art blend other than Normally (%s), so it is inserted into the psd instead'
+                        % ', '.join(self.template.art_blends), file=sys.stderr)
+                self.art_mode = 'psd'
+
+            self.keywords = load_keywords(keyword_path, cache_dir)
+
+            record_input(__file__) # Changes to the renderer itself ought to show up too
+        # Inputs of every card, even when they are only read once up here
+        self.fixed_inputs = frozenset(fixed_inputs)
+        self.template_cache = None
+        self.output_store = None
+        if cache_dir is not None:
+            self.template_cache = TemplateCache(cache_dir, template_cache_bytes)
+            # Off for benchmarks, where every repeat would otherwise just link the last one's outputs
+            self.output_store = OutputStore(cache_dir) if store_outputs else None
+            asset_cache.persist(cache_dir)
+            art_cache.persist(cache_dir)
+
+    def composite(self, data):
+        '''
+        Composites the template for a card, including its art
+
+        By default, the template is composited without art (with a template cache, at most once per `template_key`),
+        and the art is placed underneath it in PIL. This skips encoding the art into a psd layer only for psd-tools
+        to decode it again. The `psd` art mode still inserts it as a layer (as does the default, if any layer
+        over the art blends other than Normally, see `blended_layers`), and `verify` checks both agree.
+        '''
+        if self.art_mode == 'psd':
+            return self.composite_psd(data)
+
+        base = self.composite_base(data)
+        with profile_stage('art'):
+            img = place_art(base, load_art(data, self.template.art_bbox), self.template.art_bbox, self.template.art_mask)
+
+        if self.art_mode == 'verify':
+            with profile_stage('check art'):
+                expected = self.composite_psd(data).convert('RGBA')
+                # Premultiplied, as the colour of a fully transparent pixel doesn't matter
+                diff = PIL.ImageChops.difference(img.convert('RGBa'), expected.convert('RGBa'))
+                worst = max( high for _, high in diff.getextrema() )
+                assert worst <= ART_TOLERANCE, 'Art composited in PIL is off by %d (at most %d)' % (worst, ART_TOLERANCE)
+        return img
+
+    def composite_base(self, data):
+        '''
+        Composites the template for a card without any art, from the template cache if there is one
+        '''
+        psd = self.template.psd
+
+        key = None
+        if self.template_cache is not None:
+            with profile_stage('cache'):
+                key = template_key(data)
+                base = self.template_cache.get(key)
+            if base is not None:
+                return base
+
+        with profile_stage('toggle'):
+            self.template.reset()
+            edit_page_class(psd, data, insert_art=False)
+        with profile_stage('composite'):
+            # Force redraws the psd instead of grabbing from the cache / buf
+            base = psd.composite(force=True).convert('RGBA')
+
+        if key is not None:
+            with profile_stage('cache'):
+                self.template_cache.put(key, base)
+        return base
+
+    def composite_psd(self, data):
+        '''
+        Composites the template for a card with its art inserted as a layer, entirely in psd-tools
+        '''
+        psd = self.template.psd
+        with profile_stage('toggle'):
+            self.template.reset()
+            edit_page_class(psd, data, insert_art=False)
+        with profile_stage('art'):
+            page_art = add_page_art(psd, self.template.page_base, data)
+        try:
+            with profile_stage('composite'):
+                # Force redraws the psd instead of grabbing from the cache / buf
+                return psd.composite(force=True)
+        finally:
+            # Don't leave this card's art behind for the next one
+            page_art.parent.remove(page_art)
+
+    def render(self, data, outputs, encodes=None):
+        '''
+        Renders one card into any number of variants from a single composite
+
+        @param data a card dictionary obtained from an `init_data` call
+        @param outputs a list of (variant, output path) tuples, where variant is one of `VARIANTS`.
+        The output paths may also be writable binary files.
+        @param encodes Optional. If given a list (and this renderer has encode threads), returns before
+        the outputs are encoded, adding a future for each of them to the list. Otherwise returns once they are saved.
+        @return a sorted list of every input file (absolute paths) the card was rendered from
+        '''
+        with track_inputs() as inputs:
+            digests = {}
+            if self.output_store is not None:
+                # Outputs which were rendered before (from the same inputs) are linked instead
+                with profile_stage('store'):
+                    remaining = []
+                    for variant, output_path in outputs:
+                        if not isinstance(output_path, str):
+                            remaining.append( (variant, output_path) )
+                            continue
+                        if variant not in digests:
+                            digests[variant] = self.output_digest(data, variant)
+                        if not self.output_store.get(digests[variant], output_path):
+                            remaining.append( (variant, output_path) )
+                    outputs = remaining
+
+            if outputs:
+                self.draw(data, outputs, encodes, digests)
+        return sorted(inputs | self.fixed_inputs)
+
+    def output_digest(self, data, variant):
+        '''
+        Hashes everything one variant of a card is rendered from: the fields it shows, the content of every file
+        it is drawn from (art, icons, fonts), the template, this script and the output settings.
+        Only the full variant has text, so the mini doesn't depend on the preamble or dice effects.
+        '''
+        def file_hash(path):
+            record_input(path)
+            return hash_input(os.path.abspath(path))[2]
+
+        rarity = get_field(data, 'rarity').lower()
+        parts = {
+            'variant' : variant,
+            'template' : PSD_MD5,
+            'code' : code_md5(),
+            'encoding' : self.encoding,
+            'art_mode' : self.art_mode,
+            'layout' : template_key(data),
+            'name' : get_field(data, 'name'),
+            'cost' : get_field(data, 'cost'),
+            'art' : file_hash(get_field(data, 'art', relative=True)),
+            'cost_grit' : file_hash(os.path.join(self.asset_path, 'cost_grit', RARITIES[rarity][0])),
+            'fonts' : [ file_hash(find_font(TITLE_TEXT_FONT, TITLE_TEXT_SIZE).path),
+                file_hash(find_font(COST_TEXT_FONT, COST_TEXT_SIZE).path) ],
+        }
+        if variant == 'full':
+            texts = [ get_field(data, 'preamble') or '' ]
+            for dice in get_field(data, 'dice'):
+                texts += [ dice['range'], dice.get('effect', None) or '' ]
+            tokens = [ token for text in texts for token in get_keywords(text, self.keywords) ]
+            parts['text'] = [ [ token[0].value ] + list(token[1:]) for token in tokens ]
+            parts['icons'] = [ file_hash(token[1]) for token in tokens if token[0] == KeywordData.IMAGE ]
+            parts['dice'] = [ file_hash(os.path.join(self.asset_path, 'ruina', dice['type'].lower() + '.png'))
+                for dice in get_field(data, 'dice') ]
+            parts['fonts'].append(file_hash(find_font(DESC_TEXT_FONT, DESC_TEXT_SIZE).path))
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def save(self, img, output_path, variant, encodes=None, digest=None):
+        if encodes is not None and self.encoder is not None:
+            encodes.append(self.encoder.submit(self.encode, img, output_path, variant, digest))
+            return
+        with profile_stage('save'):
+            self.encode(img, output_path, variant, digest)
+
+    def encode(self, img, output_path, variant, digest=None):
+        '''
+        Saves one output, and adds it to the output store under `digest`, if given
+        '''
+        if not isinstance(output_path, str):
+            save_image(img, output_path, variant, self.encoding)
+            return
+
+        # Replaced rather than written over, as an existing output may be a link into the output store
+        with atomic_write(output_path) as tmp_path:
+            save_image(img, tmp_path, variant, self.encoding)
+        if digest is not None and self.output_store is not None:
+            self.output_store.put(digest, output_path)
+
+    def draw(self, data, outputs, encodes=None, digests=None):
+        variants = [ variant for variant, _ in outputs ]
+        for variant, img in self.variant_images(data, variants):
+            for output_variant, output_path in outputs:
+                if output_variant == variant:
+                    # Finally, output to png
+                    self.save(img, output_path, variant, encodes, (digests or {}).get(variant, None))
+
+    def variant_images(self, data, variants):
+        '''
+        Draws a card once, for each of `variants`
+
+        @return a generator of (variant, image) tuples
+        '''
+        img = self.composite(data)
+
+        # Add custom title and text
+        with profile_stage('title'):
+            img = add_title( img, data )
+        with profile_stage('cost'):
+            img = add_cost( self.asset_path, img, data )
+
+        # Crop the image to minify it, before the text is drawn on the full card
+        # (it would be entirely cropped otherwise)
+        if 'mini' in variants:
+            with profile_stage('mini'):
+                mini = img.crop( (MINI_LEFT, MINI_UP, MINI_RIGHT, MINI_DOWN) )
+            yield 'mini', mini
+
+        if 'full' in variants:
+            with profile_stage('text'):
+                img = add_text( self.asset_path, self.keywords, img, data)
+            yield 'full', img
+
+def art_signature(data):
+    '''
+    Which art a card uses, down to the version of the file
+    '''
+    art_path = os.path.abspath(get_field(data, 'art', relative=True))
+    return ( art_path, os.stat(art_path).st_mtime_ns )
 
-    if is_mini:
-        # Crop the image to minify it
-        img = img.crop( (MINI_LEFT, MINI_UP, MINI_RIGHT, MINI_DOWN) )
+class CardLayers:
+    '''
+    The separately drawn layers of one card, so that an edit to it only redraws the layers it affects.
+    Meant for live previews of a card being edited, e.g. through `render_server.py`.
+
+    Each layer is redrawn when its signature (the fields it is drawn from) changes:
+    - base: the template and art, see `CardRenderer.composite`
+    - title: `add_title`
+    - cost: `add_cost`
+    - text: `add_text`, only needed by the full variant
+    Other than the base, layers are drawn onto transparent images and only their bbox is kept.
+    Wherever the template is opaque, this is within 1/255 of drawing straight onto the card as `CardRenderer.draw` does
+    (PIL blends text into translucent pixels differently from compositing it over them).
+    '''
+    SIGNATURES = {
+        'base' : lambda data: ( template_key(data), art_signature(data) ),
+        'title' : lambda data: get_field(data, 'name'),
+        'cost' : lambda data: ( get_field(data, 'cost'), get_field(data, 'rarity').lower(), get_field(data, 'grit') is not False ),
+        'text' : lambda data: ( get_field(data, 'preamble'),
+            tuple( (dice['type'].lower(), dice['range'], dice.get('effect', None)) for dice in get_field(data, 'dice') ) ),
+    }
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.signatures = {}
+        self.layers = {} # name -> (image, position) with image None if nothing was drawn
+
+    def draw_layer(self, name, data):
+        if name == 'base':
+            self.layers[name] = (self.renderer.composite(data), (0, 0))
+            return
+
+        size = self.layers['base'][0].size
+        with profile_stage(name):
+            layer = PIL.Image.new('RGBA', size, color=(0,0,0,0))
+            if name == 'title':
+                layer = add_title(layer, data)
+            elif name == 'cost':
+                layer = add_cost(self.renderer.asset_path, layer, data)
+            else:
+                layer = add_text(self.renderer.asset_path, self.renderer.keywords, layer, data)
+            bbox = layer.getbbox()
+            self.layers[name] = (layer.crop(bbox), bbox[:2]) if bbox is not None else (None, None)
+
+    def update(self, data, variants=VARIANTS):
+        '''
+        Redraws the layers of `variants` which changed since the last update
+
+        @param data a card dictionary obtained from an `init_data` call
+        @return a list of the names of the redrawn layers
+        '''
+        names = [ 'base', 'title', 'cost' ] + ([ 'text' ] if 'full' in variants else [])
+        redrawn = []
+        try:
+            for name in names:
+                signature = self.SIGNATURES[name](data)
+                if name != 'base':
+                    # Drawn to the size of the base, but not from its pixels, so only a base of another size redraws them
+                    signature = ( signature, self.layers['base'][0].size )
+                if signature != self.signatures.get(name, None):
+                    self.draw_layer(name, data)
+                    self.signatures[name] = signature
+                    redrawn.append(name)
+        except Exception:
+            self.signatures = {} # Half updated, so start over next time
+            raise
+        return redrawn
+
+    def compose(self, names):
+        img = self.layers['base'][0].copy()
+        for name in names:
+            layer, position = self.layers[name]
+            if layer is not None:
+                img.alpha_composite(layer, dest=position)
+        return img
+
+    def render(self, data, outputs):
+        '''
+        Updates the layers for `data`, then saves every output, as `CardRenderer.render` would
+
+        @return a list of the names of the redrawn layers
+        '''
+        redrawn = self.update(data, [ variant for variant, _ in outputs ])
+        with profile_stage('compose'):
+            img = self.compose([ 'title', 'cost' ])
+        for variant, output_path in outputs:
+            if variant == 'mini':
+                self.renderer.save(img.crop( (MINI_LEFT, MINI_UP, MINI_RIGHT, MINI_DOWN) ), output_path, variant)
+        if any( variant == 'full' for variant, _ in outputs ):
+            with profile_stage('compose'):
+                layer, position = self.layers['text']
+                if layer is not None:
+                    img.alpha_composite(layer, dest=position)
+            for variant, output_path in outputs:
+                if variant == 'full':
+                    self.renderer.save(img, output_path, variant)
+        return redrawn
+
+def variant_path(output_path, variant):
+    '''
+    Names the output of a variant after the full card's output, e.g. `card.png` -> `card_mini.png`
+    '''
+    if variant == 'full':
+        return output_path
+    stem, ext = os.path.splitext(output_path)
+    return '%s_%s%s' % (stem, variant, ext)
+
+def validate_keywords(text, keywords, where):
+    errors = []
+    if not isinstance(text, str):
+        return [ '%s should be text' % where ]
+    for is_keyword, kw in split_keywords(text):
+        if not is_keyword:
+            continue
+        if kw in keywords.errors:
+            errors.append('%s: %s' % (where, keywords.errors[kw]))
+        elif kw not in keywords.keywords:
+            errors.append('%s: the keyword "%s" was not found in the keyword dictionary' % (where, kw))
+        else:
+            for token in keywords.keywords[kw]:
+                if token[0] == KeywordData.IMAGE and not os.path.isfile(token[1]):
+                    errors.append('%s: the image of keyword "%s" does not exist: %s' % (where, kw, token[1]))
+    return errors
+
+def validate_card(card_path, keywords, asset_path):
+    '''
+    Checks a card for everything that would otherwise only fail once it is being rendered, without opening the template:
+    its parents, fields, type, rarity, dice (count and types), keywords and the files it refers to
+
+    @param keywords a `KeywordIndex`
+    @return a list of error messages, empty if the card is fine
+    '''
+    try:
+        data = init_data('', card_path)
+    except (OSError, ValueError, AssertionError, TypeError, AttributeError) as error:
+        return [ 'Could not load the card or its parents: %s' % error ]
+
+    errors = []
+    for field in ('name', 'cost', 'type', 'rarity', 'art', 'dice'):
+        if get_field(data, field) is None:
+            errors.append('Missing field: %s' % field)
+    for field in ('name', 'art'):
+        value = get_field(data, field)
+        if value is not None and not isinstance(value, str):
+            errors.append('%s should be text, not %r' % (field, value))
+
+    page_type = get_field(data, 'type')
+    if page_type is not None and str(page_type).lower() not in PAGE_TYPES:
+        errors.append('No such page type: %s (choose from %s)' % (page_type, ', '.join(PAGE_TYPES)))
+
+    rarity = get_field(data, 'rarity')
+    if rarity is not None:
+        if str(rarity).lower() not in RARITIES:
+            errors.append('No such page rarity: %s (choose from %s)' % (rarity, ', '.join(RARITIES)))
+        elif not os.path.isfile(os.path.join(asset_path, 'cost_grit', RARITIES[str(rarity).lower()][0])):
+            errors.append('The cost grit of rarity %s does not exist in %s' % (rarity, asset_path))
+
+    art_path = get_field(data, 'art', relative=True) if isinstance(get_field(data, 'art'), str) else None
+    if art_path is not None and not os.path.isfile(art_path):
+        errors.append('The art does not exist: %s' % art_path)
+    elif art_path is not None:
+        try:
+            with PIL.Image.open(art_path) as art:
+                # Without the template, the size it is scaled to isn't known, so assume jpegs shrink all they can
+                check_art_pixels(art, ART_JPEG_REDUCTION if art.format == 'JPEG' else 1)
+        except (OSError, PIL.Image.DecompressionBombError, AssertionError) as error:
+            errors.append('Could not use the art %s: %s' % (art_path, error))
+
+    preamble = get_field(data, 'preamble')
+    if preamble:
+        errors += validate_keywords(preamble, keywords, 'preamble')
+
+    dice = get_field(data, 'dice')
+    if dice is not None:
+        if not isinstance(dice, list):
+            errors.append('dice should be a list')
+            dice = []
+        elif len(dice) not in DICE_COUNTS:
+            errors.append('Invalid number of dice on page: %d (the template has layouts for %s)' % (len(dice),
+                ', '.join( str(count) for count in DICE_COUNTS )))
+        for i, die in enumerate(dice):
+            where = 'dice %d' % (i + 1)
+            if not isinstance(die, dict):
+                errors.append('%s should be an object' % where)
+                continue
+            dice_type = str(die.get('type', '')).lower()
+            if dice_type not in DICE_TYPES:
+                errors.append('%s: no such dice type: %s (choose from %s)' % (where, die.get('type', None), ', '.join(DICE_TYPES)))
+            elif not os.path.isfile(os.path.join(asset_path, 'ruina', dice_type + '.png')):
+                errors.append('%s: the icon of dice type %s does not exist in %s' % (where, dice_type, asset_path))
+            if 'range' not in die:
+                errors.append('%s: missing range' % where)
+            else:
+                errors += validate_keywords(die['range'], keywords, where + ' range')
+            if die.get('effect', None):
+                errors += validate_keywords(die['effect'], keywords, where + ' effect')
+    return errors
+
+def validate(cards, asset_path, keyword_path, cache_dir=None):
+    '''
+    Validates every card (see `validate_card`), printing every error found
+
+    @param cache_dir Optional. Where the keyword index may be cached, see `load_keywords`
+    @return a dictionary of each invalid card path to its errors
+    '''
+    keywords = load_keywords(keyword_path, cache_dir)
+    invalid = {}
+    for card_path in cards:
+        errors = validate_card(card_path, keywords, asset_path)
+        if errors:
+            invalid[card_path] = errors
+            for error in errors:
+                print('%s: %s' % (card_path, error), file=sys.stderr)
+    return invalid
+
+def find_cards(data_path):
+    '''
+    Finds every card for a batch run
+
+    @param data_path either a directory (searched recursively for .json files), a single card .json,
+    or a text file listing one card .json per line
+    @return a tuple of (root directory, sorted list of card paths).
+    Outputs mirror the layout of the cards relative to the root directory.
+    '''
+    if os.path.isdir(data_path):
+        cards = []
+        for dir_path, dir_names, file_names in os.walk(data_path):
+            dir_names.sort()
+            cards += [ os.path.join(dir_path, name) for name in sorted(file_names) if name.endswith('.json') ]
+        return data_path, cards
+
+    if data_path.endswith('.json'):
+        cards = [ data_path ]
     else:
-        # Only need to add text if not mini (it would be entirely cropped otherwise)
-        img = add_text( asset_path, keyword_data, img, data)
+        with open(data_path, 'r') as list_fd:
+            cards = [ line.strip() for line in list_fd if line.strip() and not line.startswith('#') ]
+
+    root = os.path.commonpath([ os.path.dirname(os.path.abspath(card)) for card in cards ]) if cards else ''
+    return root, cards
+
+def batch_outputs(root, card_path, output_dir, variants, extension='.png'):
+    '''
+    Maps a card to its outputs, e.g. `data/test/fa_jin.json` -> `output/test/fa_jin.png` & `output/test/fa_jin_mini.png`
+
+    @return a list of (variant, output path) tuples, as taken by `CardRenderer.render`
+    '''
+    relative = os.path.relpath(os.path.abspath(card_path), os.path.abspath(root))
+    target = os.path.join(output_dir, os.path.splitext(relative)[0]) + extension
+    return [ (variant, variant_path(target, variant)) for variant in variants ]
+
+# Each process of a batch keeps its own renderer, see `init_worker`
+worker_renderer = None
+worker_profile = False
+# The stages of setting up the renderer, reported along with the first card of the process
+worker_setup_stages = None
+# Why the renderer of this process could not be set up, see `init_pool_worker`
+worker_setup_error = None
+
+def check_setup(asset_path, keyword_path, cache_dir=None, verify_strict=False, **options):
+    '''
+    Fails, in this process, on what would fail setting up every renderer of a pool: a missing or wrong psd,
+    or a missing or malformed keyword dictionary. Checked before starting a pool, as every worker failing
+    would otherwise only flood the output with the same error
+    '''
+    if cache_dir is not None:
+        hash_cache.persist(cache_dir)
+    verify_psd(os.path.join(asset_path, PSD_NAME), verify_strict)
+    load_keywords(keyword_path, cache_dir)
+
+def init_worker(asset_path, keyword_path, options, profile=False, memory_limit=None):
+    global worker_renderer, worker_profile, worker_setup_stages
+    if memory_limit is not None:
+        limit_memory(memory_limit)
+    worker_profile = profile
+    with track_stages(profile) as setup_stages:
+        worker_renderer = CardRenderer(asset_path, keyword_path, **options)
+    worker_setup_stages = setup_stages
+
+def init_pool_worker(*args):
+    '''
+    `init_worker` for a `multiprocessing.Pool`, which would replace a worker whose initializer raised
+    with a new one (failing the same way) forever. The error is kept instead, and every job given
+    to the worker fails with it (see `get_worker_renderer`)
+    '''
+    global worker_setup_error
+    try:
+        init_worker(*args)
+    except Exception:
+        worker_setup_error = traceback.format_exc()
+
+def get_worker_renderer():
+    if worker_renderer is None:
+        raise RuntimeError('The renderer of this process could not be set up:\n%s' % worker_setup_error)
+    return worker_renderer
+
+def render_job(job, encodes=None):
+    '''
+    Renders one card of a batch with this process' renderer
 
-    img.save(output_path, format='PNG') # Finally, output to png
+    @param job a tuple of (card path, outputs), as taken by `CardRenderer.render`
+    @param encodes Optional. A list to add the futures of outputs still being encoded to, see `CardRenderer.render`
+    @return a dictionary with the card path, its outputs, an error message (None if successful), the seconds taken,
+    the inputs (mapping every input file to its fingerprint, see `hash_input`),
+    and if profiling, its stages (see `track_stages`) and those of setting up this process (once)
+    '''
+    global worker_setup_stages
+    card_path, outputs = job
+    result = { 'card' : card_path, 'outputs' : outputs, 'error' : None, 'inputs' : {}, 'stages' : None, 'setup' : None }
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(outputs[0][1]) or '.', exist_ok=True)
+        with track_stages(worker_profile) as stages:
+            with track_inputs() as data_inputs:
+                with profile_stage('load'):
+                    data = init_data('', card_path)
+            inputs = get_worker_renderer().render(data, outputs, encodes)
+        for path in sorted(data_inputs.union(inputs)):
+            result['inputs'][path] = hash_input(path)
+        result['stages'] = stages
+        result['setup'], worker_setup_stages = worker_setup_stages, None
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def finish_job(result, encodes):
+    '''
+    Waits for the outputs of a `render_job` to be encoded
+
+    @return the result, with the error of a failed encode (if any)
+    '''
+    for encode in encodes:
+        try:
+            encode.result()
+        except Exception:
+            if result['error'] is None:
+                result['error'] = traceback.format_exc()
+    return result
+
+def pipeline_jobs(card_jobs, depth):
+    '''
+    Renders in this process, composing up to `depth` cards ahead of the ones still being encoded
+
+    @return a generator of results, in order
+    '''
+    pending = deque()
+    for job in card_jobs:
+        encodes = []
+        pending.append( (render_job(job, encodes), encodes) )
+        if len(pending) > depth:
+            yield finish_job(*pending.popleft())
+    while pending:
+        yield finish_job(*pending.popleft())
+
+def batch(data_path, output_dir, asset_path, keyword_path, variants=VARIANTS, jobs=1, incremental=False, profile=None,
+        memory_limit=None, check=True, **options):
+    '''
+    Renders every card found by `find_cards`, across `jobs` processes (0 for one per cpu)
+    Every process only pays for verifying + parsing the psd (and the keywords) once.
+    The inputs of every output are kept in a `Manifest` in `output_dir`;
+    when `incremental`, only outputs whose inputs changed since are rendered.
+    If given a `ProfileReport` as `profile`, every card is profiled into it.
+    Every process is held to `memory_limit` megabytes, if given (see `limit_memory`).
+    With `encode_threads`, a single process encodes its outputs in the background while composing the next cards;
+    across several processes each encodes its own, as the processes already keep every cpu busy.
+    Unless told not to `check`, cards are validated first (see `validate`), and invalid ones are not rendered at all.
+
+    @return the number of cards which failed to render (or validate)
+    '''
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    root, cards = find_cards(data_path)
+    encoding = options.get('encoding', ENCODING)
+    card_jobs = []
+    for card_path in cards:
+        outputs = batch_outputs(root, card_path, output_dir, variants, '.' + encoding['format'])
+        if incremental:
+            outputs = [ output for output in outputs if not manifest.is_current(output[1], encoding) ]
+        if outputs:
+            card_jobs.append( (card_path, outputs) )
+
+    invalid = validate([ card_path for card_path, _ in card_jobs ], asset_path, keyword_path,
+            options.get('cache_dir', None)) if check else {}
+    if invalid:
+        print('%d card(s) failed to validate, and will not be rendered' % len(invalid), file=sys.stderr)
+        card_jobs = [ job for job in card_jobs if job[0] not in invalid ]
+
+    if not card_jobs:
+        if not invalid:
+            print('All %d cards are up to date' % len(cards))
+        manifest.save()
+        return len(invalid)
+
+    jobs = jobs or os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(card_jobs)))
+
+    start = time.perf_counter()
+    failures = 0
+    pool = None
+    encode_threads = options.pop('encode_threads', 0)
+    if jobs == 1:
+        init_worker(asset_path, keyword_path, dict(options, encode_threads=encode_threads), profile is not None, memory_limit)
+        results = pipeline_jobs(card_jobs, encode_threads) if encode_threads > 0 else map(render_job, card_jobs)
+    else:
+        check_setup(asset_path, keyword_path, **options)
+        # Workers pull one card at a time, so slow cards don't hold up a whole chunk
+        pool = multiprocessing.Pool(jobs,
+                initializer=init_pool_worker,
+                initargs=(asset_path, keyword_path, options, profile is not None, memory_limit))
+        results = pool.imap_unordered(render_job, card_jobs)
+
+    try:
+        for i, result in enumerate(results):
+            print('[%*d/%d] %6.2fs %s' % (len(str(len(card_jobs))), i + 1, len(card_jobs), result['seconds'], result['card']))
+            if result['error'] is not None:
+                failures += 1
+                print(result['error'], file=sys.stderr)
+                continue
+
+            for variant, output_path in result['outputs']:
+                manifest.record(output_path, result['inputs'], encoding)
+            if profile is not None:
+                if result['setup'] is not None:
+                    profile.add(result['setup'])
+                profile.add(result['stages'], result['card'])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        manifest.save()
+
+    elapsed = time.perf_counter() - start
+    print('Rendered %d cards (%d failed) in %.2fs with %d process(es)' % (len(card_jobs) - failures,
+        failures,
+        elapsed,
+        jobs))
+    return failures + len(invalid)
+
+def render_image_job(job):
+    '''
+    Renders one card of a deck with this process' renderer, without saving it
+
+    @param job a tuple of (card path, variant)
+    @return a tuple of (card path, image, error message), with the image None if it failed
+    '''
+    card_path, variant = job
+    try:
+        data = init_data('', card_path)
+        for _, img in get_worker_renderer().variant_images(data, (variant,)):
+            return card_path, img, None
+    except Exception:
+        return card_path, None, traceback.format_exc()
+
+def deck(data_path, output_path, asset_path, keyword_path, variant='full', columns=DECK_COLUMNS, rows=DECK_ROWS,
+        jobs=1, memory_limit=None, check=True, **options):
+    '''
+    Renders every card found by `find_cards` (listing a card twice puts it in the deck twice) straight into sheets
+    of `columns` x `rows` cards, e.g. for tabletop simulators, instead of a file per card.
+    Only one sheet is held in memory at a time, and each card on it is only rendered once.
+    Writes the sheet to `output_path` (or `<name>_<n>` for each, if there is more than one) along with
+    an atlas, `<name>.json`, of where every card is.
+
+    @return the number of cards which failed to render (their slots are left empty)
+    '''
+    _, cards = find_cards(data_path)
+    invalid = validate(list(dict.fromkeys(cards)), asset_path, keyword_path, options.get('cache_dir', None)) if check else {}
+    if invalid:
+        # Not worth rendering the rest of a deck which is missing cards
+        print('%d card(s) failed to validate, so the deck was not rendered' % len(invalid), file=sys.stderr)
+        return sum( card_path in invalid for card_path in cards )
+
+    encoding = options.get('encoding', ENCODING)
+    per_sheet = columns * rows
+    sheet_count = max(1, ceil(len(cards) / per_sheet))
+    name, extension = os.path.splitext(output_path)
+    atlas = { 'variant' : variant, 'columns' : columns, 'rows' : rows, 'card_size' : None, 'sheets' : [], 'cards' : [] }
+
+    jobs = jobs or os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(cards)))
+    pool = None
+    if jobs == 1:
+        init_worker(asset_path, keyword_path, options, memory_limit=memory_limit)
+    else:
+        check_setup(asset_path, keyword_path, **options)
+        pool = multiprocessing.Pool(jobs,
+                initializer=init_pool_worker,
+                initargs=(asset_path, keyword_path, options, False, memory_limit))
+
+    start = time.perf_counter()
+    failures = 0
+    rendered = 0
+    try:
+        for sheet_index in range(sheet_count):
+            sheet_path = output_path if sheet_count == 1 else '%s_%d%s' % (name, sheet_index + 1, extension)
+            slots = OrderedDict() # card path -> its slots on this sheet
+            for slot, card_path in enumerate(cards[sheet_index * per_sheet:(sheet_index + 1) * per_sheet]):
+                slots.setdefault(card_path, []).append(slot)
+
+            card_jobs = [ (card_path, variant) for card_path in slots ]
+            results = pool.imap(render_image_job, card_jobs) if pool is not None else map(render_image_job, card_jobs)
+            sheet = None
+            for card_path, img, error in results:
+                # Counted by slot, as a card listed twice is rendered once but fills both
+                rendered += len(slots[card_path])
+                print('[%*d/%d] %s' % (len(str(len(cards))), rendered, len(cards), card_path))
+                if error is not None:
+                    failures += len(slots[card_path])
+                    print(error, file=sys.stderr)
+                    continue
+
+                if sheet is None:
+                    atlas['card_size'] = list(img.size)
+                    sheet = PIL.Image.new('RGBA', (columns * img.width, rows * img.height), color=(0,0,0,0))
+                for slot in slots[card_path]:
+                    x, y = (slot % columns) * img.width, (slot // columns) * img.height
+                    sheet.paste(img.convert('RGBA'), (x, y))
+                    atlas['cards'].append({
+                        'card' : card_path,
+                        'index' : sheet_index * per_sheet + slot,
+                        'sheet' : len(atlas['sheets']),
+                        'box' : [ x, y, x + img.width, y + img.height ],
+                    })
+
+            if sheet is not None:
+                os.makedirs(os.path.dirname(sheet_path) or '.', exist_ok=True)
+                save_image(sheet, sheet_path, variant, encoding)
+                atlas['sheets'].append({ 'path' : sheet_path, 'size' : list(sheet.size) })
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    atlas['cards'].sort(key=lambda entry: entry['index'])
+    with open(name + '.json', 'w') as atlas_fd:
+        json.dump(atlas, atlas_fd, indent=4)
+
+    elapsed = time.perf_counter() - start
+    print('Rendered %d cards (%d failed) onto %d sheet(s) in %.2fs with %d process(es)' % (len(cards) - failures,
+        failures,
+        len(atlas['sheets']),
+        elapsed,
+        jobs))
+    return failures
+
+def main(data_path, output_path, asset_path, keyword_path, variants=('full',), profile=None, memory_limit=None,
+        check=True, **options):
+    '''
+    Renders a single card
+
+    @return 1 if the card failed to validate (see `validate`), otherwise 0
+    '''
+    if check and validate([ data_path ], asset_path, keyword_path, options.get('cache_dir', None)):
+        return 1
+    if memory_limit is not None:
+        limit_memory(memory_limit)
+    with track_stages(profile is not None) as setup_stages:
+        renderer = CardRenderer(asset_path, keyword_path, **options)
+    if len(variants) == 1:
+        # A lone variant goes exactly where it was asked to
+        outputs = [ (variants[0], output_path) ]
+    else:
+        outputs = [ (variant, variant_path(output_path, variant)) for variant in variants ]
+
+    with track_stages(profile is not None) as stages:
+        with profile_stage('load'):
+            data = init_data('', data_path)
+        renderer.render(data, outputs)
+
+    if profile is not None:
+        profile.add(setup_stages)
+        profile.add(stages, data_path)
+    return 0
+
+def parse_variants(text):
+    variants = [ variant.strip() for variant in text.split(',') if variant.strip() ]
+    for variant in variants:
+        if variant not in VARIANTS:
+            raise argparse.ArgumentTypeError('No such variant: %s (choose from %s)' % (variant, ', '.join(VARIANTS)))
+    return tuple(dict.fromkeys(variants))
 
 def get_args():
     # Parse command line using the built-in argparse library
     parser = argparse.ArgumentParser()
     parser.add_argument('data_path', type=str, help='Path to data to create a card')
-    parser.add_argument('output_path', type=str, help='Path to output (ought to be a png file)')
+    parser.add_argument('output_path', type=str, nargs='?', default=None,
+            help='Path to output (ought to be a png file). Not needed with `--validate`')
     parser.add_argument('-m', '--mini', action='store_true', default=False,
-            help='A mini card (just the cover)')
+            help='A mini card (just the cover). Short for `--variants mini`')
+    parser.add_argument('-v', '--variants', type=parse_variants, default=None,
+            help='Comma separated variants to render from a single composite, e.g. `full,mini`. '
+            'Other than `full`, each is written next to the output with a `_<variant>` suffix')
+    parser.add_argument('-b', '--batch', action='store_true', default=False,
+            help='Render many cards in one process. `data_path` is then a directory of cards '
+            '(or a text file listing one card per line) and `output_path` is the output directory. '
+            'Writes both the card and its `_mini` unless told otherwise')
+    parser.add_argument('-d', '--deck', action='store_true', default=False,
+            help='Render many cards (like `-b`) into grid sheets instead, e.g. for tabletop simulators. '
+            '`output_path` is then the sheet, and an atlas of where each card is goes next to it as a .json. '
+            'Takes a single variant')
+    parser.add_argument('--columns', type=int, default=DECK_COLUMNS,
+            help='Cards per row of a deck sheet (`-d`)')
+    parser.add_argument('--rows', type=int, default=DECK_ROWS,
+            help='Rows of cards per deck sheet (`-d`). Further cards go onto more sheets')
+    parser.add_argument('--validate', action='store_true', default=False,
+            help='Only check the cards (`data_path`, which may be a folder or list as for `-b`) for errors, '
+            'such as unknown keywords, rarities, types or dice and missing files or parents, without rendering anything. '
+            'This is always done before rendering, unless `--no-validate` is given')
+    parser.add_argument('--no-validate', action='store_true', default=False,
+            help='Skip checking cards before rendering them')
+    parser.add_argument('-i', '--incremental', action='store_true', default=False,
+            help='With `-b`, only render outputs whose inputs (the card, its parents, art, keywords, icons, fonts, '
+            'the template...) changed since they were last rendered into the same output folder')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='Number of processes to render a batch (`-b`) or deck (`-d`) with. 0 uses one per cpu')
+    parser.add_argument('-p', '--profile', nargs='?', const='-', default=os.environ.get('ruina_profile', None),
+            help='Time each stage of rendering (wall + cpu time, peak memory), summarised in a table once done. '
+            'If given a path, every card is also written to it as a line of JSON. '
+            'Can also be turned on with the `ruina_profile` environment variable (set to a path, or `-`)')
     parser.add_argument('-a', '--asset-path', type=str, default=None,
             help='Path to the assets folder. Defaults to ../assets (relative to this script)')
     parser.add_argument('-k', '--keyword-path', type=str, default=None,
             help='Path to keywords JSON. Defaults to ../assets/keywords.json (also relative)')
+    parser.add_argument('-c', '--cache-dir', type=str, default=None,
+            help='Folder to cache composited templates in, so most cards skip compositing the psd. '
+            'Entries are discarded automatically when the psd changes. Off by default')
+    parser.add_argument('--verify-strict', action='store_true', default=False,
+            help='Always read the whole psd to check that it is the right one. '
+            'Otherwise, with `-c`, it is only checked again once it changes (in size, modified time or inode)')
+    parser.add_argument('--template-cache-mb', type=int, default=TEMPLATE_CACHE_BYTES // (1024 * 1024),
+            help='Size limit of the template cache in megabytes (least recently used entries are evicted first)')
+    parser.add_argument('--art-mode', choices=ART_MODES, default='pil',
+            help='How art is put under the template: `pil` pastes it under the composited template (the default), '
+            '`psd` inserts it into the psd as a layer like older versions, '
+            '`verify` does both and fails if they differ by more than %d/255' % ART_TOLERANCE)
+    parser.add_argument('-M', '--memory-limit-mb', type=int, default=None,
+            help='Memory limit of each rendering process in megabytes (of address space, so leave some room). '
+            'A card which needs more fails on its own instead of the whole machine running out of memory')
+    parser.add_argument('-f', '--format', choices=('png', 'webp'), default=None,
+            help='Image format to output. Defaults to png, or webp for a single card whose output path ends in .webp. '
+            'In a batch (`-b`), outputs take its extension')
+    parser.add_argument('--png-compress-level', type=int, choices=range(10), default=None, metavar='{0..9}',
+            help='Zlib compression level of png outputs; lower is faster but larger. Defaults to PIL\'s (6)')
+    parser.add_argument('--png-strategy', choices=tuple(PNG_STRATEGIES), default=None,
+            help='Zlib strategy of png outputs. `rle` and `huffman` are much faster to encode than the default, at some size')
+    parser.add_argument('--quantize-mini', type=int, default=0, metavar='COLORS',
+            help='Reduce mini png outputs to a palette of this many colors (at most 256), much smaller files. Off (0) by default')
+    parser.add_argument('--webp-lossless', action='store_true', default=False,
+            help='Encode webp outputs losslessly')
+    parser.add_argument('--webp-quality', type=int, default=ENCODING['webp_quality'],
+            help='Quality (0 to 100) of webp outputs, or effort when lossless')
+    parser.add_argument('--webp-method', type=int, choices=range(7), default=ENCODING['webp_method'], metavar='{0..6}',
+            help='Webp encoder method; lower is faster but larger')
+    parser.add_argument('--encode-threads', type=int, default=0,
+            help='Number of threads to encode outputs with in the background, while the next cards are composed. '
+            'Only helps a batch (`-b`) rendered in one process. Off (0) by default')
     args = parser.parse_args()
 
     # As stated in the help text, `<scriptdir>/../assets/`
@@ -564,8 +2510,83 @@ def get_args():
             '..',
             'assets',
             'keywords.json')
-    return (args.data_path, args.output_path, args.asset_path, args.keyword_path, args.mini)
+    if args.variants is None:
+        if args.mini:
+            args.variants = ('mini',)
+        elif args.batch:
+            args.variants = VARIANTS
+        else:
+            args.variants = ('full',)
+    if args.output_path is None and not args.validate:
+        parser.error('the following arguments are required: output_path')
+    if args.deck and len(args.variants) != 1:
+        parser.error('A deck (-d) takes a single variant')
+    if args.format is None:
+        if not args.batch and (args.output_path or '').lower().endswith('.webp'):
+            args.format = 'webp'
+        else:
+            args.format = 'png'
+    if not 0 <= args.quantize_mini <= 256:
+        parser.error('--quantize-mini takes 0 to 256 colors')
+    return args
+
+def renderer_options(args):
+    '''
+    The keyword arguments for `CardRenderer` (besides the asset & keyword paths) from the command line
+    '''
+    return {
+        'cache_dir' : args.cache_dir,
+        'template_cache_bytes' : args.template_cache_mb * 1024 * 1024,
+        'encoding' : {
+            'format' : args.format,
+            'png_compress_level' : args.png_compress_level,
+            'png_strategy' : args.png_strategy,
+            'quantize_mini' : args.quantize_mini,
+            'webp_lossless' : args.webp_lossless,
+            'webp_quality' : args.webp_quality,
+            'webp_method' : args.webp_method,
+        },
+        'encode_threads' : args.encode_threads,
+        'art_mode' : args.art_mode,
+        'verify_strict' : args.verify_strict,
+    }
 
 if __name__ == '__main__':
-    main(*get_args())
+    args = get_args()
+    profile = None
+    if args.profile is not None:
+        profile = ProfileReport(None if args.profile == '-' else args.profile)
+
+    failures = 0
+    if args.validate:
+        _, cards = find_cards(args.data_path)
+        cards = list(dict.fromkeys(cards))
+        failures = len(validate(cards, args.asset_path, args.keyword_path, args.cache_dir))
+        print('%d of %d cards are valid' % (len(cards) - failures, len(cards)))
+    elif args.deck:
+        failures = deck(args.data_path, args.output_path, args.asset_path, args.keyword_path, args.variants[0],
+                columns=args.columns,
+                rows=args.rows,
+                jobs=args.jobs,
+                memory_limit=args.memory_limit_mb,
+                check=not args.no_validate,
+                **renderer_options(args))
+    elif args.batch:
+        failures = batch(args.data_path, args.output_path, args.asset_path, args.keyword_path, args.variants,
+                jobs=args.jobs,
+                incremental=args.incremental,
+                profile=profile,
+                memory_limit=args.memory_limit_mb,
+                check=not args.no_validate,
+                **renderer_options(args))
+    else:
+        failures = main(args.data_path, args.output_path, args.asset_path, args.keyword_path, args.variants,
+                profile=profile,
+                memory_limit=args.memory_limit_mb,
+                check=not args.no_validate,
+                **renderer_options(args))
+
+    if profile is not None:
+        profile.summary()
+    sys.exit(1 if failures else 0)
 
@@ -0,0 +1,261 @@
+import argparse
+import base64
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+
+import generate_card
+
+# Constants
+DEFAULT_QUEUE = 8 # Requests which may wait for a worker, on top of those being rendered
+DEFAULT_PNG_COMPRESS_LEVEL = 1 # Previews are thrown away, so favor speed over size
+SESSION_ENTRIES = 16 # Cards whose layers each process keeps, see `render_request`
+
+# The `generate_card.CardLayers` of this process, by session
+sessions = OrderedDict()
+
+def render_request(request):
+    '''
+    Renders one request with this process' renderer (see `generate_card.init_worker`)
+
+    @param request a dictionary with either `card` (the card itself) or `card_path` (a card file), and optionally:
+    - id: anything, returned as is
+    - base_dir: the directory the relative paths of an inline `card` are relative to (its parent, art...)
+    - variant: one of `generate_card.VARIANTS`, `full` by default
+    - output: a path to write the image to, instead of returning it
+    - session: anything naming the card being edited. Its layers are kept, so the next request with the same session
+    only redraws the layers whose fields changed. Sessions are per process, so with several processes some requests
+    may still render from scratch
+    @return a response dictionary with the id, an error message (None if successful), the milliseconds taken,
+    either the `image` bytes or the `path` it was written to, and for a session, the layers which were `redrawn`
+    '''
+    start = time.perf_counter()
+    response = { 'id' : request.get('id', None), 'error' : None }
+    try:
+        variant = request.get('variant', 'full')
+        assert variant in generate_card.VARIANTS, 'No such variant: %s' % variant
+        if 'card_path' in request:
+            data = generate_card.init_data('', request['card_path'])
+        else:
+            data = generate_card.data_resolver.load_inline(request['card'], request.get('base_dir', '.'))
+
+        output_path = request.get('output', None)
+        if output_path is not None:
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            output = output_path
+        else:
+            output = io.BytesIO()
+
+        session = request.get('session', None)
+        if session is not None:
+            session = json.dumps(session)
+            layers = sessions.pop(session, None) or generate_card.CardLayers(generate_card.get_worker_renderer())
+            sessions[session] = layers
+            while len(sessions) > SESSION_ENTRIES:
+                sessions.popitem(last=False)
+            response['redrawn'] = layers.render(data, [ (variant, output) ])
+        else:
+            generate_card.get_worker_renderer().render(data, [ (variant, output) ])
+
+        if output_path is not None:
+            response['path'] = os.path.abspath(output_path)
+        else:
+            response['image'] = output.getvalue()
+    except Exception:
+        response['error'] = traceback.format_exc()
+    response['ms'] = 1000 * (time.perf_counter() - start)
+    return response
+
+class RenderPool:
+    '''
+    Processes which each keep a `generate_card.CardRenderer` (and its caches) warm between requests.
+    At most `jobs + queue` requests are in flight at once; past that, `submit` waits for a slot or refuses.
+    '''
+    def __init__(self, asset_path, keyword_path, jobs=1, queue=DEFAULT_QUEUE, **options):
+        jobs = jobs or os.cpu_count() or 1
+        generate_card.check_setup(asset_path, keyword_path, **options)
+        self.pool = multiprocessing.Pool(jobs,
+                initializer=generate_card.init_pool_worker,
+                initargs=(asset_path, keyword_path, options))
+        self.slots = threading.BoundedSemaphore(jobs + queue)
+
+    def submit(self, request, callback, block=True):
+        '''
+        Renders a request (see `render_request`) in the background, passing its response to `callback`
+
+        @param block whether to wait for a slot when too many requests are in flight
+        @return False if refused for being too busy
+        '''
+        if not self.slots.acquire(blocking=block):
+            return False
+
+        def done(response):
+            self.slots.release()
+            callback(response)
+
+        def failed(error):
+            done({ 'id' : request.get('id', None), 'error' : repr(error) })
+
+        self.pool.apply_async(render_request, (request,), callback=done, error_callback=failed)
+        return True
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class RenderHandler(BaseHTTPRequestHandler):
+    '''
+    `POST /render` takes a request (see `render_request`) as its JSON body.
+    It replies with the image, or with JSON for a request with an `output` or one which failed.
+    '''
+    def do_GET(self):
+        if self.path != '/health':
+            self.reply_json(404, { 'error' : 'No such endpoint: %s' % self.path })
+            return
+        self.reply_json(200, { 'ok' : True })
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.reply_json(404, { 'error' : 'No such endpoint: %s' % self.path })
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            assert isinstance(request, dict), 'Expected a JSON object'
+        except (ValueError, AssertionError) as error:
+            self.reply_json(400, { 'error' : 'Invalid request: %s' % error })
+            return
+
+        done = threading.Event()
+        responses = []
+        def callback(response):
+            responses.append(response)
+            done.set()
+
+        if not self.server.render_pool.submit(request, callback, block=False):
+            self.reply_json(503, { 'error' : 'Too many requests in flight' }, { 'Retry-After' : '1' })
+            return
+        done.wait()
+
+        response = responses[0]
+        headers = { 'X-Render-Ms' : '%.1f' % response['ms'] } if 'ms' in response else {}
+        if 'redrawn' in response:
+            headers['X-Redrawn'] = ','.join(response['redrawn'])
+        if response['error'] is not None:
+            self.reply_json(400, response, headers)
+        elif 'image' in response:
+            self.reply(200, response['image'], 'image/' + self.server.image_format, headers)
+        else:
+            self.reply_json(200, response, headers)
+
+    def reply_json(self, status, body, headers=None):
+        self.reply(status, json.dumps(body).encode(), 'application/json', headers)
+
+    def reply(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def serve_http(render_pool, host, port, image_format, verbose=False):
+    server = ThreadingHTTPServer((host, port), RenderHandler)
+    server.render_pool = render_pool
+    server.image_format = image_format
+    server.verbose = verbose
+    print('Serving on http://%s:%d/render' % server.server_address[:2], file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def serve_stdin(render_pool):
+    '''
+    Reads one request (see `render_request`) per line of stdin, and writes one response per line of stdout.
+    Responses come back as soon as they are done, which may be out of order, so requests ought to have an `id`.
+    Images are base64 encoded. Reading stops while too many requests are in flight.
+    '''
+    lock = threading.Lock()
+    def reply(response):
+        if 'image' in response:
+            response['image'] = base64.b64encode(response['image']).decode('ascii')
+        with lock:
+            sys.stdout.write(json.dumps(response) + '\n')
+            sys.stdout.flush()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            assert isinstance(request, dict), 'Expected a JSON object'
+        except (ValueError, AssertionError) as error:
+            reply({ 'id' : None, 'error' : 'Invalid request: %s' % error })
+            continue
+        render_pool.submit(request, reply)
+
+def get_args():
+    # Parse command line using the built-in argparse library
+    parser = argparse.ArgumentParser(description='Keeps the template, keywords and caches loaded between renders, '
+            'taking cards over HTTP (`POST /render`) or as JSON lines on stdin')
+    parser.add_argument('--stdin', action='store_true', default=False,
+            help='Read requests from stdin (one JSON object per line) and write responses to stdout, instead of serving HTTP')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+            help='Address to serve HTTP on. Defaults to 127.0.0.1 (this machine only)')
+    parser.add_argument('--port', type=int, default=8765,
+            help='Port to serve HTTP on')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='Number of processes to render with. 0 uses one per cpu')
+    parser.add_argument('-q', '--queue', type=int, default=DEFAULT_QUEUE,
+            help='Number of requests which may wait for a process. Past that, HTTP requests are refused (503) '
+            'and stdin is no longer read until one finishes')
+    parser.add_argument('-a', '--asset-path', type=str, default=None,
+            help='Path to the assets folder. Defaults to ../assets (relative to this script)')
+    parser.add_argument('-k', '--keyword-path', type=str, default=None,
+            help='Path to keywords JSON. Defaults to ../assets/keywords.json (also relative)')
+    parser.add_argument('-c', '--cache-dir', type=str, default=None,
+            help='Cache folder to render with, as for `generate_card.py`. Strongly recommended, '
+            'as most previews then skip compositing the psd')
+    parser.add_argument('-f', '--format', choices=('png', 'webp'), default='png',
+            help='Image format to render')
+    parser.add_argument('--png-compress-level', type=int, choices=range(10), default=DEFAULT_PNG_COMPRESS_LEVEL,
+            metavar='{0..9}', help='Zlib compression level of pngs; lower is faster but larger')
+    parser.add_argument('-V', '--verbose', action='store_true', default=False,
+            help='Log every HTTP request')
+    args = parser.parse_args()
+
+    # As stated in the help text, relative to `<scriptdir>/../`
+    if args.asset_path is None:
+        args.asset_path = os.path.join(os.path.dirname(sys.argv[0]), '..', 'assets')
+    if args.keyword_path is None:
+        args.keyword_path = os.path.join(os.path.dirname(sys.argv[0]), '..', 'assets', 'keywords.json')
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    render_pool = RenderPool(args.asset_path, args.keyword_path,
+            jobs=args.jobs,
+            queue=args.queue,
+            cache_dir=args.cache_dir,
+            encoding=dict(generate_card.ENCODING, format=args.format, png_compress_level=args.png_compress_level))
+    try:
+        if args.stdin:
+            serve_stdin(render_pool)
+        else:
+            serve_http(render_pool, args.host, args.port, args.format, args.verbose)
+    finally:
+        render_pool.close()
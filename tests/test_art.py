@@ -0,0 +1,74 @@
+import os
+import sys
+
+import PIL.Image
+import PIL.ImageChops
+from psd_tools import PSDImage
+from psd_tools.api.layers import Group, PixelLayer
+from psd_tools.compression import Compression
+from psd_tools.constants import BlendMode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import generate_card
+
+SIZE = (96, 64)
+ART_BOX = (16, 8, 80, 56)
+
+def make_template(shade_blend=None):
+    '''
+    A tiny stand-in for the template: a `Card Base` group holding the sample art (`176m2`) under a translucent frame,
+    and optionally a shade blended with `shade_blend` on top
+    '''
+    psd = PSDImage.new('RGBA', SIZE)
+    page_base = Group.new('Card Base', parent=psd)
+
+    sample = PixelLayer.frompil(PIL.Image.new('RGBA', (ART_BOX[2] - ART_BOX[0], ART_BOX[3] - ART_BOX[1]), 'white'),
+            psd, '176m2', top=ART_BOX[1], left=ART_BOX[0], compression=Compression.RLE)
+    page_base.append(sample)
+
+    # Opaque at the edges, fading to clear in the middle, so the art shows through by varying amounts
+    frame = PIL.Image.new('RGBA', SIZE, (120, 60, 30, 255))
+    frame.putalpha(PIL.Image.radial_gradient('L').resize(SIZE))
+    page_base.append(PixelLayer.frompil(frame, psd, 'Frame', compression=Compression.RLE))
+
+    if shade_blend is not None:
+        shade = PixelLayer.frompil(PIL.Image.new('RGBA', SIZE, (200, 220, 90, 160)), psd, 'Shade',
+                compression=Compression.RLE)
+        shade.blend_mode = shade_blend
+        page_base.append(shade)
+    return psd, page_base, sample
+
+def make_art():
+    return PIL.Image.effect_noise((ART_BOX[2] - ART_BOX[0], ART_BOX[3] - ART_BOX[1]), 64).convert('RGB')
+
+def composite_both(psd, page_base, sample, art):
+    '''
+    @return the template composited with the art placed in PIL, and with the art inserted into the psd
+    '''
+    sample.visible = False
+    base = psd.composite(force=True).convert('RGBA')
+    placed = generate_card.place_art(base, art, ART_BOX, generate_card.art_mask(page_base, psd.size))
+
+    page_base.insert(0, PixelLayer.frompil(art, psd, 'Art', top=ART_BOX[1], left=ART_BOX[0],
+            compression=Compression.RLE))
+    inserted = psd.composite(force=True).convert('RGBA')
+    return placed, inserted
+
+def worst_difference(a, b):
+    # Premultiplied, as the colour of a fully transparent pixel doesn't matter
+    diff = PIL.ImageChops.difference(a.convert('RGBa'), b.convert('RGBa'))
+    return max( high for _, high in diff.getextrema() )
+
+def test_placed_art_matches_psd():
+    psd, page_base, sample = make_template()
+    assert generate_card.blended_layers(sample) == []
+    placed, inserted = composite_both(psd, page_base, sample, make_art())
+    assert worst_difference(placed, inserted) <= generate_card.ART_TOLERANCE
+
+def test_blended_layers_are_found():
+    psd, page_base, sample = make_template(BlendMode.MULTIPLY)
+    assert generate_card.blended_layers(sample) == [ 'Shade' ]
+
+    # Which is why the art has to go through psd-tools for these
+    placed, inserted = composite_both(psd, page_base, sample, make_art())
+    assert worst_difference(placed, inserted) > generate_card.ART_TOLERANCE